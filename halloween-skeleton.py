@@ -1,27 +1,57 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-'''
-TODOS
-=====
-
-* Something more elegant for joints synthesized from multiple joints
-'''
-
+import argparse
+import bisect
+import collections
+import concurrent.futures
+import contextlib
 import glob
+import json
 import math
+import multiprocessing
+import numpy as np
 from openni import openni2, nite2, utils
+import os
 import pygame
+import queue
 import random
+import struct
 import subprocess
 import sys
+import threading
 import time
+import zlib
+
+STARTUP_TS = time.perf_counter()
 
 SHOW_FPS = False
+# Also show the recent p50/p95/max of every frame stage under the FPS
+SHOW_STATS = False
 DEBUG_NO_KINECT = False
 
 IDLE_IMAGE_TIMEOUT_S = 5
 FADE_LENGTH_S = 1
+# Idle images kept decoded and scaled: the one shown, the one fading out and the next one
+IDLE_IMAGE_CACHE_SIZE = 3
+# Effects played while an idle image is shown (on top of the slow pan), one picked at random per image.
+# zoom and twist run once over the time an image is shown, wave and color loop every period_s.
+# Sizes are relative to the display height.
+IDLE_EFFECTS = {
+    'none': {},
+    'zoom': {'zoom': 1.12},
+    'wave': {'amplitude': 0.008, 'wavelength': 0.2, 'period_s': 2},
+    'twist': {'angle': 40, 'radius': 0.5},
+    'color': {'period_s': 6},
+}
+# Effects are rendered into a few frames per image on the loader thread, and played back by
+# blending the two frames nearest in time, so showing them costs about as much as a cross-fade.
+# Large displays get fewer frames to stay under the memory cap per image.
+IDLE_EFFECT_FRAMES = 8
+IDLE_EFFECT_MAX_BYTES = 48 * 1024 * 1024
+# While nobody is around only the slideshow is drawn, at this rate outside of fades, which is enough
+# for the pan to move about a pixel per frame. None draws it at the full frame rate.
+IDLE_RENDER_FPS = 20
 
 CAPTURE_SIZE_KINECT = (512, 424)
 CAPTURE_SIZE_OTHERS = (640, 480)
@@ -47,70 +77,949 @@ DEPTH_SPACE_Y_ADJUST = 100
 
 RESET_TIMEOUT_S = 3
 
-BODYPART_LIST = {
-    'left-femur': {
-        'joints': (nite2.JointType.NITE_JOINT_LEFT_HIP, nite2.JointType.NITE_JOINT_LEFT_KNEE),
-        'coords': ((64, 18), (32, 330)),
-    },
-    'left-lower-arm-and-hand': {
-        'joints': (nite2.JointType.NITE_JOINT_LEFT_ELBOW, nite2.JointType.NITE_JOINT_LEFT_HAND),
-        'coords': ((62, 5), (62, 211)),
-    },
-    'left-shin-and-foot': {
-        'joints': (nite2.JointType.NITE_JOINT_LEFT_KNEE, nite2.JointType.NITE_JOINT_LEFT_FOOT),
-        'coords': ((72, 16), (47, 308)),
-    },
-    'left-upper-arm': {
-        'joints': (nite2.JointType.NITE_JOINT_LEFT_SHOULDER, nite2.JointType.NITE_JOINT_LEFT_ELBOW),
-        'coords': ((30, 20), (31, 237))
-    },
-    'pelvis': {
-        'joints': (nite2.JointType.NITE_JOINT_LEFT_HIP, nite2.JointType.NITE_JOINT_RIGHT_HIP),
-        'coords': ((29, 50), (177, 50))
-    },
-    'ribcage': {
-        'joints': (nite2.JointType.NITE_JOINT_NECK, (nite2.JointType.NITE_JOINT_LEFT_HIP, nite2.JointType.NITE_JOINT_RIGHT_HIP)),
-        'coords': ((164, 1), (164, 354)),
-    },
-    'right-femur': {
-        'joints': (nite2.JointType.NITE_JOINT_RIGHT_HIP, nite2.JointType.NITE_JOINT_RIGHT_KNEE),
-        'coords': ((16, 19), (48, 330)),
-    },
-    'right-lower-arm-and-hand': {
-        'joints': (nite2.JointType.NITE_JOINT_RIGHT_ELBOW, nite2.JointType.NITE_JOINT_RIGHT_HAND),
-        'coords': ((61, 5), (61, 211)),
-    },
-    'right-shin-and-foot': {
-        'joints': (nite2.JointType.NITE_JOINT_RIGHT_KNEE, nite2.JointType.NITE_JOINT_RIGHT_FOOT),
-        'coords': ((29, 16), (55, 308)),
-    },
-    'right-upper-arm': {
-        'joints': (nite2.JointType.NITE_JOINT_RIGHT_SHOULDER, nite2.JointType.NITE_JOINT_RIGHT_ELBOW),
-        'coords': ((32, 18), (29, 237)),
-    },
-    'skull':  {
-        'joints': (nite2.JointType.NITE_JOINT_HEAD, nite2.JointType.NITE_JOINT_NECK),
-        'coords': ((63, 98), (63, 219)),
-    },
-}
+# 'surface' draws with pygame blits onto the display surface, 'texture' draws everything as textured
+# quads through SDL's renderer (pygame._sdl2), from one atlas texture for all body parts, using the
+# GPU when SDL has an accelerated renderer and its software renderer otherwise
+RENDER_BACKEND = 'surface'
+# Uploaded images the texture backend keeps: the idle image frames, the message and the overlay
+TEXTURE_CACHE_SIZE = IDLE_IMAGE_CACHE_SIZE * IDLE_EFFECT_FRAMES + 3
 
+# Only repaint the areas body parts moved through instead of flipping the whole display.
+# Frames showing the idle slideshow or the user message are always flipped in full.
+DIRTY_RECTS = False
 
-class BodyPart(pygame.sprite.Sprite):
-    def __init__(self, name, joints, joint_coords):
-        pygame.sprite.Sprite.__init__(self)
+# Draw a glowing silhouette of the tracked users behind their skeletons, from NiTE's user map.
+# The map is sampled every SILHOUETTE_MAP_STEP depth pixels, blurred over SILHOUETTE_BLUR samples
+# and scaled up to the display along with the skeletons.
+SILHOUETTE_ENABLED = False
+SILHOUETTE_MAP_STEP = 2
+SILHOUETTE_BLUR = 3
+SILHOUETTE_COLOR = (120, 200, 255)
+SILHOUETTE_ALPHA = 110
+
+# Skeleton images are decoded in parallel at startup and packed into one display-format atlas
+ASSET_LOADER_THREADS = 4
+ATLAS_WIDTH = 1024
+ATLAS_PADDING = 2
+
+# Tracker frames are read on a background thread into a small latest-wins buffer
+CAPTURE_BUFFER_SIZE = 2
+CAPTURE_JOIN_TIMEOUT_S = 2
+# Number of samples kept per stage for the latency counters
+STATS_WINDOW = 600
+# Upper bounds of the frame time histogram buckets, the last bucket counts everything slower
+STATS_HISTOGRAM_MS = (1, 2, 4, 8, 16, 33, 66, 100, 250, 1000)
+# Dumped percentiles are estimated from buckets this much wider than the one before, from 10 us to 10 s,
+# so an interval takes the same memory however many frames it has
+STATS_PERCENTILE_STEP = 0.02
+# With --stats FILE, per-stage percentiles and histograms of every interval are appended to FILE,
+# as JSON lines, or as CSV if the name ends in .csv
+STATS_DUMP_INTERVAL_S = 60
+STATS_OVERLAY_REFRESH_S = 0.5
+
+# Run OpenNI/NiTE in a supervised child process, so a driver crash or hang only restarts
+# the tracker while the display keeps going. Benchmarks always track in-process.
+TRACKER_PROCESS = True
+TRACKER_POLL_S = 0.1
+# Tracker frames read per second while there are no users, a new user is still noticed within
+# one frame at this rate. None reads every frame.
+TRACKER_IDLE_FPS = 10
+# A child that sends no frame for this long is considered hung and gets killed.
+# Starting and resetting the driver gets longer, the Kinect tilt takes a few seconds.
+TRACKER_HANG_TIMEOUT_S = 3
+TRACKER_START_TIMEOUT_S = 20
+TRACKER_STOP_TIMEOUT_S = 3
+# Delay before restarting a failed child, doubled for every restart that fails without a frame
+TRACKER_RESTART_DELAY_S = 0.5
+TRACKER_RESTART_MAX_DELAY_S = 30
+
+# Recorded skeleton files, see SkeletonRecorder
+RECORDING_MAGIC = b'HSKR'
+RECORDING_VERSION = 1
+# Horizontal spacing of the extra users a replay clones to reach the requested user count
+REPLAY_CLONE_SPACING = 150
+# Depth camera projection used for the synthetic benchmark skeleton (Kinect 640x480 depth stream)
+SYNTHETIC_PROJECTION = (571.0, 320.0, -571.0, 240.0)
+# Thickness of the synthetic skeleton's limbs in its user map, in mm
+SYNTHETIC_LIMB_RADIUS = 90
+BENCHMARK_FRAMES = 600
+BENCHMARK_SIZE = (1920, 1080)
+# User counts compared by --sweep
+BENCHMARK_USER_COUNTS = (1, 2, 4, 6)
+
+# Joints below this confidence don't position body parts
+JOINT_CONFIDENCE_THRESHOLD = 0.4
+# Joints are smoothed with a One-Euro filter in depth space (units are depth pixels), see JointFilter.
+# Lower min cutoff (Hz) means less jitter when still, higher beta means less lag when moving fast.
+JOINT_FILTER_ENABLED = True
+JOINT_FILTER_MIN_CUTOFF = 1.0
+JOINT_FILTER_BETA = 0.05
+JOINT_FILTER_D_CUTOFF = 1.0
+# Joints that drop below the confidence threshold are still drawn this long, with the confidence of
+# their last good measurement. Like every joint they move on their last velocity for at most
+# JOINT_PREDICTION_MAX_S past that measurement, then hold still for the rest of the time.
+JOINT_FILTER_COAST_S = 0.3
+# Poses are extrapolated to when the frame will be on screen, this long after the render loop
+# starts it (about a refresh at 60 Hz plus NiTE's own processing), but never further than
+# JOINT_PREDICTION_MAX_S past the last measurement
+JOINT_PREDICTION_LEAD_S = 0.03
+JOINT_PREDICTION_MAX_S = 0.1
+# Noise added to the synthetic skeleton for --filter-report, in depth pixels
+FILTER_REPORT_NOISE = 3.0
+
+# Body part sprites are cached pre-scaled and pre-rotated, quantized into buckets.
+# The bucket sizes are the accuracy/latency knob: smaller steps track limbs more
+# precisely but need more cache entries (and more misses before the cache is warm).
+SPRITE_CACHE_ENABLED = True
+SPRITE_CACHE_SCALE_STEP = 0.02
+SPRITE_CACHE_ANGLE_STEP = 2
+SPRITE_CACHE_SMOOTH = True
+SPRITE_CACHE_MAX_BYTES = 256 * 1024 * 1024
+# Optionally render every bucket in this scale range at load time (until the memory cap is hit).
+# Scales are relative to the source images at display resolution.
+SPRITE_CACHE_PREFILL = False
+SPRITE_CACHE_PREFILL_SCALES = (0.3, 1.2)
+
+# The quality governor watches how long frames take to render and steps down through these levels
+# when they run over the frame budget, and back up once there's room again. Level 0 is full quality.
+# smooth: smoothscale body parts, scale_step/angle_step: sprite cache buckets, idle_fade: 'crossfade'
+# both idle images, 'fade' only the incoming one over black or 'cut' without fading, idle_blend: blend
+# idle effect frames instead of showing the nearest one, tracker_fps: how often new tracker frames are
+# processed, None for every frame (the joint filter extrapolates in between)
+GOVERNOR_ENABLED = True
+QUALITY_LEVELS = (
+    {'smooth': SPRITE_CACHE_SMOOTH, 'scale_step': SPRITE_CACHE_SCALE_STEP, 'angle_step': SPRITE_CACHE_ANGLE_STEP,
+     'idle_fade': 'crossfade', 'idle_blend': True, 'tracker_fps': None},
+    {'smooth': False, 'scale_step': SPRITE_CACHE_SCALE_STEP, 'angle_step': SPRITE_CACHE_ANGLE_STEP,
+     'idle_fade': 'crossfade', 'idle_blend': True, 'tracker_fps': None},
+    {'smooth': False, 'scale_step': 0.04, 'angle_step': 4, 'idle_fade': 'fade', 'idle_blend': False,
+     'tracker_fps': None},
+    {'smooth': False, 'scale_step': 0.06, 'angle_step': 6, 'idle_fade': 'fade', 'idle_blend': False,
+     'tracker_fps': 20},
+    {'smooth': False, 'scale_step': 0.1, 'angle_step': 10, 'idle_fade': 'cut', 'idle_blend': False,
+     'tracker_fps': 15},
+)
+# Frames are judged by their 90th percentile render time over the window, against the frame budget.
+# Quality drops right away when over GOVERNOR_DOWNGRADE of the budget, but only rises after staying
+# under GOVERNOR_UPGRADE of it for GOVERNOR_UPGRADE_HOLD_S. Frames within GOVERNOR_COOLDOWN_S of a change aren't judged.
+GOVERNOR_WINDOW = 30
+GOVERNOR_DOWNGRADE = 0.9
+GOVERNOR_UPGRADE = 0.5
+GOVERNOR_UPGRADE_HOLD_S = 5
+GOVERNOR_COOLDOWN_S = 1
+
+# Body part images and the joints that place them, see Rig
+RIG_FILE = 'rigs.json'
+RIG = 'skeleton'
+
+NUM_JOINTS = 15
+
+# Memory layout of NiteSkeletonJoint, so a skeleton's joints can be read as one array
+NITE_JOINT_DTYPE = np.dtype([
+    ('type', '<i4'),
+    ('position', '<f4', 3),
+    ('confidence', '<f4'),
+    ('orientation', '<f4', 4),
+    ('orientation_confidence', '<f4'),
+])
+
+class Rig():
+    # A costume: the skeleton-images/ part drawn for each pair of joints, in drawing order, with the
+    # image coordinates the joints go to. A joint is a NiTE joint name or a weighted sum of joints,
+    # e.g. {"LEFT_HIP": 0.5, "RIGHT_HIP": 0.5} for the hip midpoint, or weights past 1 to extend a bone.
+    # Everything is compiled to arrays up front: rig joint positions are one weight matrix product
+    # of the NiTE joints, and their confidence is the lowest of the joints they're made of.
+    def __init__(self, name, parts):
         self.name = name
+        self.part_names = []
+        self.part_coords = []
+        rows = []
+        part_joints = []
+        for part_name, part in parts.items():
+            if len(part.get('joints', ())) != 2 or len(part.get('coords', ())) != 2:
+                raise ValueError('part {} needs two joints and two coords'.format(part_name))
+            indices = []
+            for joint in part['joints']:
+                row = self.joint_weights(joint)
+                for index, existing in enumerate(rows):
+                    if np.array_equal(existing, row):
+                        break
+                else:
+                    index = len(rows)
+                    rows.append(row)
+                indices.append(index)
+            self.part_names.append(part_name)
+            self.part_coords.append(tuple(tuple(coord) for coord in part['coords']))
+            part_joints.append(indices)
+        # (rig joints, NiTE joints)
+        self.weights = np.array(rows).reshape(-1, NUM_JOINTS)
+        self.components = self.weights != 0
+        # (parts, 2) rig joint indices, pivot first
+        self.part_joints = np.array(part_joints, dtype=np.intp).reshape(-1, 2)
+
+    def joint_weights(self, joint):
+        if isinstance(joint, str):
+            joint = {joint: 1}
+        row = np.zeros(NUM_JOINTS)
+        for joint_name, weight in joint.items():
+            joint_type = getattr(nite2.JointType, 'NITE_JOINT_' + joint_name, None)
+            if joint_type is None:
+                raise ValueError('unknown joint {}'.format(joint_name))
+            row[int(joint_type)] += weight
+        return row
+
+    @classmethod
+    def load(cls, name, filename=RIG_FILE):
+        with open(filename) as f:
+            rigs = json.load(f)
+        if name not in rigs:
+            raise ValueError('{}: no rig named {} (rigs: {})'.format(filename, name, ', '.join(rigs)))
+        try:
+            return cls(name, rigs[name]['parts'])
+        except ValueError as e:
+            raise ValueError('{}: rig {}: {}'.format(filename, name, e))
+
+def read_joints(user):
+    joints = user.skeleton.joints
+    try:
+        data = np.frombuffer(joints, dtype=NITE_JOINT_DTYPE, count=NUM_JOINTS)
+        return data['position'], data['confidence']
+    except (TypeError, ValueError):
+        positions = np.array([(j.position.x, j.position.y, j.position.z) for j in joints[:NUM_JOINTS]])
+        confidence = np.array([j.positionConfidence for j in joints[:NUM_JOINTS]])
+        return positions, confidence
+
+def read_user_map(ut_frame, step=SILHOUETTE_MAP_STEP):
+    # Returns the user id of every step-th depth pixel in both directions, and the step. NiTE's map is
+    # viewed in place rather than copied, so it's only valid until the frame is released.
+    if isinstance(ut_frame, RecordedFrame):
+        return ut_frame.user_map, ut_frame.user_map_step
+    user_map = ut_frame.userMap
+    if not user_map.pixels:
+        return None, 0
+    pixels = np.ctypeslib.as_array(user_map.pixels, shape=(user_map.height, user_map.stride // 2))
+    return pixels[::step, :user_map.width:step], step
+
+def box_blur(values, radius):
+    # Separable box blur of a 2D array through cumulative sums, treating the outside as zero
+    size = 2 * radius + 1
+    for axis in (0, 1):
+        padding = [(0, 0), (0, 0)]
+        padding[axis] = (radius + 1, radius)
+        sums = np.cumsum(np.pad(values, padding), axis=axis)
+        count = values.shape[axis]
+        values = (np.take(sums, np.arange(size, size + count), axis=axis) -
+                  np.take(sums, np.arange(count), axis=axis)) / size
+    return values
+
+class JointProjection():
+    # NiTE's joint to depth conversion is a pinhole projection, so it is measured once
+    # per tracker and then applied to all joints as an array instead of one FFI call each
+    CALIBRATION_POINTS = ((-500, -500, 2000), (500, 500, 2000), (300, -200, 3000))
+    CALIBRATION_TOLERANCE = 0.5
+
+    def __init__(self):
+        self.user_tracker = None
+        self.params = None
+
+    def calibrate(self, user_tracker):
+        self.user_tracker = user_tracker
+        self.params = None
+        try:
+            points = [(p, user_tracker.convert_joint_coordinates_to_depth(*p)) for p in self.CALIBRATION_POINTS]
+        except Exception:
+            return
+
+        (a, (ax, ay)), (b, (bx, by)), (c, (cx, cy)) = points
+        fx = (bx - ax) / (b[0] / b[2] - a[0] / a[2])
+        fy = (by - ay) / (b[1] / b[2] - a[1] / a[2])
+        if fx == 0 or fy == 0:
+            return
+        params = (fx, ax - fx * a[0] / a[2], fy, ay - fy * a[1] / a[2])
+        # Only trust the fit if it also predicts a point it wasn't fitted to
+        predicted = self.apply(params, np.array([c], dtype=np.float64))[0]
+        if abs(predicted[0] - cx) < self.CALIBRATION_TOLERANCE and abs(predicted[1] - cy) < self.CALIBRATION_TOLERANCE:
+            self.params = params
+
+    def apply(self, params, positions):
+        fx, cx, fy, cy = params
+        z = positions[:, 2]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            depth = np.stack((cx + fx * positions[:, 0] / z, cy + fy * positions[:, 1] / z), axis=1)
+        depth[z <= 0] = 0
+        return depth
+
+    def project(self, user_tracker, positions):
+        if user_tracker is not self.user_tracker:
+            self.calibrate(user_tracker)
+        if self.params is not None:
+            return self.apply(self.params, positions)
+        return np.array([user_tracker.convert_joint_coordinates_to_depth(*p) for p in positions.tolist()]).reshape(-1, 2)
+
+class JointFilter():
+    # One-Euro filter (Casiez et al. 2012) over all joints of all users at once, with the filtered
+    # velocity used to extrapolate poses to display time. Each user has a row in the state arrays.
+    def __init__(self, min_cutoff=JOINT_FILTER_MIN_CUTOFF, beta=JOINT_FILTER_BETA, d_cutoff=JOINT_FILTER_D_CUTOFF,
+                 coast_s=JOINT_FILTER_COAST_S, max_prediction_s=JOINT_PREDICTION_MAX_S):
+        self.min_cutoff = min_cutoff
+        self.beta = beta
+        self.d_cutoff = d_cutoff
+        self.coast_s = coast_s
+        self.max_prediction_s = max_prediction_s
+        self.rows = {}
+        self.free_rows = []
+        self.position = np.zeros((0, NUM_JOINTS, 2))
+        self.velocity = np.zeros((0, NUM_JOINTS, 2))
+        # Time and confidence of the last confident measurement per joint
+        self.timestamp = np.zeros((0, NUM_JOINTS))
+        self.confidence = np.zeros((0, NUM_JOINTS))
+        self.raw_confidence = np.zeros((0, NUM_JOINTS))
+        self.frame_ts = np.zeros(0)
+
+    def alpha(self, cutoff, dt):
+        tau = 1 / (2 * math.pi * cutoff)
+        return 1 / (1 + tau / dt)
+
+    def allocate(self, user_id, positions, confidence):
+        if self.free_rows:
+            row = self.free_rows.pop()
+        else:
+            row = len(self.position)
+            self.position = np.concatenate((self.position, positions[None]))
+            self.velocity = np.concatenate((self.velocity, np.zeros_like(positions)[None]))
+            self.timestamp = np.concatenate((self.timestamp, np.zeros_like(confidence)[None]))
+            self.confidence = np.concatenate((self.confidence, confidence[None]))
+            self.raw_confidence = np.concatenate((self.raw_confidence, confidence[None]))
+            self.frame_ts = np.append(self.frame_ts, 0)
+        self.position[row] = positions
+        self.velocity[row] = 0
+        self.timestamp[row] = -math.inf
+        self.confidence[row] = confidence
+        self.raw_confidence[row] = confidence
+        self.frame_ts[row] = -math.inf
+        self.rows[user_id] = row
+
+    def update(self, user_ids, positions, confidence, timestamp):
+        # positions and confidence are (users, joints) arrays in user_ids order
+        for user_id, user_positions, user_confidence in zip(user_ids, positions, confidence):
+            if user_id not in self.rows:
+                self.allocate(user_id, user_positions, user_confidence)
+        rows = [self.rows[user_id] for user_id in user_ids]
+        position = self.position[rows]
+        velocity = self.velocity[rows]
+        last_ts = self.timestamp[rows]
+        confident = confidence > JOINT_CONFIDENCE_THRESHOLD
+        dt = timestamp - last_ts
+        recent = dt <= self.coast_s
+        # Confident joints seen recently are filtered, the others restart from the measurement.
+        # Joints that aren't confident keep their state while coasting and follow the measurement after.
+        filtered = confident & recent & (dt > 0)
+        restarted = (confident & ~recent) | ~(confident | recent)
+        if filtered.any():
+            dt_f = dt[filtered][:, None]
+            measured_velocity = (positions[filtered] - position[filtered]) / dt_f
+            velocity[filtered] += self.alpha(self.d_cutoff, dt_f) * (measured_velocity - velocity[filtered])
+            cutoff = self.min_cutoff + self.beta * np.linalg.norm(velocity[filtered], axis=1)[:, None]
+            position[filtered] += self.alpha(cutoff, dt_f) * (positions[filtered] - position[filtered])
+        position[restarted] = positions[restarted]
+        velocity[restarted] = 0
+        last_ts[confident] = timestamp
+        last_confidence = self.confidence[rows]
+        last_confidence[confident] = confidence[confident]
+        self.position[rows] = position
+        self.velocity[rows] = velocity
+        self.timestamp[rows] = last_ts
+        self.confidence[rows] = last_confidence
+        self.raw_confidence[rows] = confidence
+        self.frame_ts[rows] = timestamp
+
+    def predict(self, user_ids, target_ts):
+        # Returns the positions at target_ts, extrapolated at most max_prediction_s past each joint's
+        # last good measurement, and the confidences, where coasting joints keep the confidence of
+        # their last good measurement
+        rows = [self.rows[user_id] for user_id in user_ids]
+        last_ts = self.timestamp[rows]
+        lead = np.clip(target_ts - last_ts, 0, self.max_prediction_s)
+        positions = self.position[rows] + self.velocity[rows] * lead[..., None]
+        coasting = self.frame_ts[rows, None] - last_ts <= self.coast_s
+        confidence = np.where(coasting, self.confidence[rows], self.raw_confidence[rows])
+        return positions, confidence
+
+    def evict(self, user_id):
+        row = self.rows.pop(user_id, None)
+        if row is not None:
+            self.free_rows.append(row)
+
+class JointBatch():
+    def __init__(self, rig):
+        self.rig = rig
+        self.projection = JointProjection()
+        self.joint_filter = JointFilter() if JOINT_FILTER_ENABLED else None
+        # Depth space (after the render adjustment) to display transform: x * scale_x + offset_x, y * scale_y
+        self.scale_x = 1
+        self.offset_x = 0
+        self.scale_y = 1
+        self.user_ids = []
+        self.depth = {}
+        self.screen = {}
+        self.confidence = {}
+        # The same, stacked in user_ids order
+        self.screen_array = None
+        self.confidence_array = None
+
+    def set_display_transform(self, scale, margin, width, mirrored):
+        self.scale_x = -scale if mirrored else scale
+        self.offset_x = margin + width if mirrored else margin
+        self.scale_y = scale
+
+    def update(self, user_tracker, users, timestamp):
+        # Converts the joints of every user to depth space and feeds them to the filter
+        self.user_ids = [user.id for user in users]
+        self.depth = {}
+        if not users:
+            return
+        positions = np.empty((len(users), NUM_JOINTS, 3))
+        confidence = np.empty((len(users), NUM_JOINTS))
+        for i, user in enumerate(users):
+            positions[i], confidence[i] = read_joints(user)
+        depth = self.projection.project(user_tracker, positions.reshape(-1, 3)).reshape(len(users), NUM_JOINTS, 2)
+        depth += (DEPTH_SPACE_X_ADJUST, DEPTH_SPACE_Y_ADJUST)
+        if self.joint_filter is not None:
+            self.joint_filter.update(self.user_ids, depth, confidence, timestamp)
+        else:
+            for i, user in enumerate(users):
+                self.depth[user.id] = (depth[i], confidence[i])
+
+    def predict(self, target_ts):
+        # Display positions and confidences of every rig joint of every user at target_ts
+        self.screen = {}
+        self.confidence = {}
+        if not self.user_ids:
+            return
+        if self.joint_filter is not None:
+            depth, confidence = self.joint_filter.predict(self.user_ids, target_ts)
+        else:
+            depth = np.array([self.depth[user_id][0] for user_id in self.user_ids])
+            confidence = np.array([self.depth[user_id][1] for user_id in self.user_ids])
+        screen = np.einsum('rj,ujc->urc', self.rig.weights, depth)
+        screen *= (self.scale_x, self.scale_y)
+        screen[..., 0] += self.offset_x
+        confidence = np.where(self.rig.components, confidence[:, np.newaxis, :], np.inf).min(axis=2)
+        self.screen_array = screen
+        self.confidence_array = confidence
+        for i, user_id in enumerate(self.user_ids):
+            self.screen[user_id] = screen[i]
+            self.confidence[user_id] = confidence[i]
+
+    def evict(self, user_id):
+        if self.joint_filter is not None:
+            self.joint_filter.evict(user_id)
+        self.depth.pop(user_id, None)
+        if user_id in self.user_ids:
+            self.user_ids.remove(user_id)
+
+RECORDING_HEADER = struct.Struct('<4sHH4d')
+RECORDING_FRAME = struct.Struct('<dIH')
+RECORDING_USER = struct.Struct('<HBB')
+RECORDING_USER_MAP = struct.Struct('<HHBI')
+RECORDING_JOINT_DTYPE = np.dtype([
+    ('position', '<f4', 3),
+    ('confidence', '<f4'),
+    ('depth', '<f4', 2),
+])
+
+def encode_header(projection):
+    params = projection.params if projection.params is not None else (math.nan,) * 4
+    return RECORDING_HEADER.pack(RECORDING_MAGIC, RECORDING_VERSION, NUM_JOINTS, *params)
+
+def decode_header(data, offset=0):
+    # Returns the projection
+    magic, version, joint_count, *params = RECORDING_HEADER.unpack_from(data, offset)
+    if (magic != RECORDING_MAGIC or version != RECORDING_VERSION or
+            joint_count != NUM_JOINTS):
+        raise ValueError('not a version {} skeleton recording'.format(RECORDING_VERSION))
+    return None if any(math.isnan(p) for p in params) else tuple(params)
+
+def encode_user_map(user_map, step):
+    # Maps are mostly zeros, so they compress well even at the fastest level
+    if user_map is None:
+        return RECORDING_USER_MAP.pack(0, 0, 0, 0)
+    data = zlib.compress(user_map.astype('<u2').tobytes(), 1)
+    height, width = user_map.shape
+    return RECORDING_USER_MAP.pack(width, height, step, len(data)) + data
+
+def decode_user_map(data, offset):
+    # Returns the map, its step and the offset just past it
+    width, height, step, size = RECORDING_USER_MAP.unpack_from(data, offset)
+    offset += RECORDING_USER_MAP.size
+    if width == 0:
+        return None, 0, offset
+    user_map = np.frombuffer(zlib.decompress(data[offset:offset + size]), dtype='<u2').reshape(height, width)
+    return user_map, step, offset + size
+
+def encode_frame(ut_frame, user_tracker, projection, timestamp, index, user_maps=True):
+    users = ut_frame.users
+    chunks = [RECORDING_FRAME.pack(timestamp, index, len(users))]
+    for user in users:
+        positions, confidence = read_joints(user)
+        joints = np.empty(NUM_JOINTS, dtype=RECORDING_JOINT_DTYPE)
+        joints['position'] = positions
+        joints['confidence'] = confidence
+        joints['depth'] = projection.project(user_tracker, positions.astype(np.float64))
+        chunks.append(RECORDING_USER.pack(user.id, int(user.state), int(user.skeleton.state)))
+        chunks.append(joints.tobytes())
+    chunks.append(encode_user_map(*read_user_map(ut_frame)) if user_maps else encode_user_map(None, 0))
+    return b''.join(chunks)
+
+def decode_frame(data, offset=0):
+    # Returns the frame and the offset just past it
+    timestamp, index, user_count = RECORDING_FRAME.unpack_from(data, offset)
+    offset += RECORDING_FRAME.size
+    users = []
+    for _ in range(user_count):
+        user_id, state, skeleton_state = RECORDING_USER.unpack_from(data, offset)
+        offset += RECORDING_USER.size
+        record = np.frombuffer(data, dtype=RECORDING_JOINT_DTYPE, count=NUM_JOINTS, offset=offset).copy()
+        offset += NUM_JOINTS * RECORDING_JOINT_DTYPE.itemsize
+        users.append(RecordedUser(user_id, state, skeleton_state, record))
+    user_map, step, offset = decode_user_map(data, offset)
+    return RecordedFrame(timestamp, index, users, user_map, step), offset
+
+class SkeletonRecorder():
+    # Binary format: a header with the fitted depth projection (NaN if it couldn't be fitted), then
+    # per frame a timestamp, index and user count, per user its id, states and joint records, and
+    # the frame's user map (16-bit user ids, sampled every SILHOUETTE_MAP_STEP pixels and compressed) if it had one
+    def __init__(self, filename):
+        self.file = open(filename, 'wb')
+        self.projection = JointProjection()
+        self.start_ts = None
+        self.frame_count = 0
+
+    def write(self, ut_frame, user_tracker, timestamp):
+        if self.start_ts is None:
+            self.projection.calibrate(user_tracker)
+            self.file.write(encode_header(self.projection))
+            self.start_ts = timestamp
+        self.file.write(encode_frame(ut_frame, user_tracker, self.projection, timestamp - self.start_ts, self.frame_count))
+        self.frame_count = self.frame_count + 1
+
+    def close(self):
+        self.file.close()
+
+class RecordedSkeleton():
+    def __init__(self, state, joints):
+        self.state = state
         self.joints = joints
-        self.joint_coords = joint_coords
-        if len(joints) == 2:
-            joint_vector = (joint_coords[0][0] - joint_coords[1][0], joint_coords[0][1] - joint_coords[1][1])
-            self.joint_length = math.sqrt(sum(v**2 for v in joint_vector))
-            self.angle_orig = self.get_angle(joint_coords[0][0], joint_coords[0][1], joint_coords[1][0], joint_coords[1][1])
 
-        filename = 'skeleton-images/{}.png'.format(self.name)
-        self.image_orig = pygame.image.load(filename)
+class RecordedUser():
+    def __init__(self, user_id, state, skeleton_state, record):
+        self.id = user_id
+        self.state = state
+        self.record = record
+        joints = np.zeros(NUM_JOINTS, dtype=NITE_JOINT_DTYPE)
+        joints['type'] = np.arange(NUM_JOINTS)
+        joints['position'] = record['position']
+        joints['confidence'] = record['confidence']
+        self.skeleton = RecordedSkeleton(skeleton_state, joints)
+
+    def is_new(self):
+        return self.state == nite2.UserState.NITE_USER_STATE_NEW
+
+    def is_visible(self):
+        return self.state == nite2.UserState.NITE_USER_STATE_VISIBLE
+
+    def is_lost(self):
+        return self.state == nite2.UserState.NITE_USER_STATE_LOST
+
+    def clone(self, user_id, shift, params):
+        # Moves the copy sideways in depth space, keeping its 3D position consistent with the projection
+        record = self.record.copy()
+        record['depth'][:, 0] += shift
+        if params is not None:
+            record['position'][:, 0] += shift * record['position'][:, 2] / params[0]
+        else:
+            record['position'][:, 0] += shift
+        return RecordedUser(user_id, self.state, self.skeleton.state, record)
+
+class RecordedFrame():
+    def __init__(self, timestamp, index, users, user_map=None, user_map_step=0):
+        self.timestamp = timestamp
+        self.frameIndex = index
+        self.users = users
+        self.users_by_id = {user.id: user for user in users}
+        self.user_map = user_map
+        self.user_map_step = user_map_step
+
+def load_recording(filename):
+    with open(filename, 'rb') as f:
+        data = f.read()
+    try:
+        params = decode_header(data)
+    except ValueError as e:
+        raise ValueError('{}: {}'.format(filename, e))
+    frames = []
+    offset = RECORDING_HEADER.size
+    while offset < len(data):
+        frame, offset = decode_frame(data, offset)
+        frames.append(frame)
+    return params, frames
+
+def synthesize_user_map(depth, positions, bones, user_id, params, step=SILHOUETTE_MAP_STEP):
+    # Draws every bone as a thick line with round ends, SYNTHETIC_LIMB_RADIUS thick at its depth
+    fx, cx, fy, cy = params
+    surface = pygame.Surface((int(2 * cx) // step, int(2 * cy) // step), depth=8)
+    points = (depth / step).tolist()
+    radii = SYNTHETIC_LIMB_RADIUS * fx / positions[bones, 2].mean(axis=1) / step
+    for (start, end), radius in zip(bones, radii):
+        pygame.draw.line(surface, user_id, points[start], points[end], max(1, int(2 * radius)))
+        pygame.draw.circle(surface, user_id, points[start], radius)
+        pygame.draw.circle(surface, user_id, points[end], radius)
+    return pygame.surfarray.array2d(surface).T.astype(np.uint8)
+
+def clone_user_map(user_map, source_id, user_id, columns):
+    # Adds a copy of a user's pixels moved sideways by columns, under a new id
+    mask = user_map == source_id
+    width = mask.shape[1]
+    if abs(columns) >= width:
+        return
+    shifted = np.zeros_like(mask)
+    if columns >= 0:
+        shifted[:, columns:] = mask[:, :width - columns]
+    else:
+        shifted[:, :columns] = mask[:, -columns:]
+    user_map[shifted] = user_id
+
+def synthesize_recording(frame_count=BENCHMARK_FRAMES, fps=30, user_maps=False):
+    # A skeleton standing in front of the camera, swaying and waving both arms
+    params = SYNTHETIC_PROJECTION
+    rest = {
+        nite2.JointType.NITE_JOINT_HEAD: (0, 650),
+        nite2.JointType.NITE_JOINT_NECK: (0, 420),
+        nite2.JointType.NITE_JOINT_LEFT_SHOULDER: (-180, 400),
+        nite2.JointType.NITE_JOINT_RIGHT_SHOULDER: (180, 400),
+        nite2.JointType.NITE_JOINT_LEFT_ELBOW: (-450, 400),
+        nite2.JointType.NITE_JOINT_RIGHT_ELBOW: (450, 400),
+        nite2.JointType.NITE_JOINT_LEFT_HAND: (-700, 400),
+        nite2.JointType.NITE_JOINT_RIGHT_HAND: (700, 400),
+        nite2.JointType.NITE_JOINT_TORSO: (0, 150),
+        nite2.JointType.NITE_JOINT_LEFT_HIP: (-100, -50),
+        nite2.JointType.NITE_JOINT_RIGHT_HIP: (100, -50),
+        nite2.JointType.NITE_JOINT_LEFT_KNEE: (-110, -480),
+        nite2.JointType.NITE_JOINT_RIGHT_KNEE: (110, -480),
+        nite2.JointType.NITE_JOINT_LEFT_FOOT: (-120, -900),
+        nite2.JointType.NITE_JOINT_RIGHT_FOOT: (120, -900),
+    }
+    base = np.zeros((NUM_JOINTS, 3))
+    for joint, (x, y) in rest.items():
+        base[int(joint)] = (x, y, 2500)
+    arms = {
+        int(nite2.JointType.NITE_JOINT_LEFT_ELBOW): (-1, 1),
+        int(nite2.JointType.NITE_JOINT_LEFT_HAND): (-1, 2),
+        int(nite2.JointType.NITE_JOINT_RIGHT_ELBOW): (1, 1),
+        int(nite2.JointType.NITE_JOINT_RIGHT_HAND): (1, 2),
+    }
+    joint = nite2.JointType
+    bones = np.array([
+        (joint.NITE_JOINT_HEAD, joint.NITE_JOINT_NECK), (joint.NITE_JOINT_NECK, joint.NITE_JOINT_TORSO),
+        (joint.NITE_JOINT_LEFT_SHOULDER, joint.NITE_JOINT_RIGHT_SHOULDER),
+        (joint.NITE_JOINT_LEFT_SHOULDER, joint.NITE_JOINT_LEFT_ELBOW), (joint.NITE_JOINT_LEFT_ELBOW, joint.NITE_JOINT_LEFT_HAND),
+        (joint.NITE_JOINT_RIGHT_SHOULDER, joint.NITE_JOINT_RIGHT_ELBOW), (joint.NITE_JOINT_RIGHT_ELBOW, joint.NITE_JOINT_RIGHT_HAND),
+        (joint.NITE_JOINT_TORSO, joint.NITE_JOINT_LEFT_HIP), (joint.NITE_JOINT_TORSO, joint.NITE_JOINT_RIGHT_HIP),
+        (joint.NITE_JOINT_LEFT_HIP, joint.NITE_JOINT_LEFT_KNEE), (joint.NITE_JOINT_LEFT_KNEE, joint.NITE_JOINT_LEFT_FOOT),
+        (joint.NITE_JOINT_RIGHT_HIP, joint.NITE_JOINT_RIGHT_KNEE), (joint.NITE_JOINT_RIGHT_KNEE, joint.NITE_JOINT_RIGHT_FOOT),
+    ], dtype=np.intp)
+    frames = []
+    for i in range(frame_count):
+        t = i / fps
+        positions = base.copy()
+        positions[:, 0] += 300 * math.sin(t * 0.7)
+        positions[:, 2] += 400 * math.sin(t * 0.3)
+        for joint, (side, segments) in arms.items():
+            wave = 0.8 * math.sin(t * 3)
+            positions[joint, 0] = positions[int(nite2.JointType.NITE_JOINT_NECK), 0] + side * (180 + 260 * segments * math.cos(wave))
+            positions[joint, 1] = 400 + 260 * segments * math.sin(wave)
+        record = np.empty(NUM_JOINTS, dtype=RECORDING_JOINT_DTYPE)
+        record['position'] = positions
+        record['confidence'] = 1
+        record['depth'] = JointProjection().apply(params, positions)
+        state = nite2.UserState.NITE_USER_STATE_NEW if i == 0 else nite2.UserState.NITE_USER_STATE_VISIBLE
+        skeleton_state = nite2.SkeletonState.NITE_SKELETON_NONE if i == 0 else nite2.SkeletonState.NITE_SKELETON_TRACKED
+        user_map = synthesize_user_map(record['depth'], positions, bones, 1, params) if user_maps else None
+        frames.append(RecordedFrame(t, i, [RecordedUser(1, int(state), int(skeleton_state), record)],
+                                    user_map, SILHOUETTE_MAP_STEP if user_maps else 0))
+    return params, frames
+
+class RecordedUserTracker():
+    # Stands in for nite2.UserTracker when the frames were recorded, or read in another process
+    def __init__(self, params):
+        self.params = params
+        self.depth_lookup = {}
+
+    def index_depth(self, users):
+        # Without a fitted projection, joints can only be converted through the recorded depth positions
+        if self.params is None:
+            self.depth_lookup = {}
+            for user in users:
+                for position, depth in zip(user.record['position'].tolist(), user.record['depth'].tolist()):
+                    self.depth_lookup[tuple(position)] = tuple(depth)
+
+    def start_skeleton_tracking(self, user_id):
+        pass
+
+    def stop_skeleton_tracking(self, user_id):
+        pass
+
+    def convert_joint_coordinates_to_depth(self, x, y, z):
+        if self.params is not None:
+            fx, cx, fy, cy = self.params
+            return (cx + fx * x / z, cy + fy * y / z) if z > 0 else (0.0, 0.0)
+        return self.depth_lookup.get((x, y, z), (0.0, 0.0))
+
+class ReplayUserTracker(RecordedUserTracker):
+    # Plays back a recording in a loop
+    def __init__(self, params, frames, user_count=None, realtime=True):
+        super().__init__(params)
+        self.frames = frames
+        self.user_count = user_count
+        self.realtime = realtime
+        self.position = 0
+        self.start_ts = None
+
+    @classmethod
+    def open(cls, filename, **kwargs):
+        params, frames = load_recording(filename)
+        return cls(params, frames, **kwargs)
+
+    def read_frame(self):
+        if self.position >= len(self.frames):
+            self.position = 0
+            self.start_ts = None
+        frame = self.frames[self.position]
+        self.position = self.position + 1
+        if self.realtime:
+            if self.start_ts is None:
+                self.start_ts = time.perf_counter() - frame.timestamp
+            # Like the sensor, frames that weren't read in time are skipped
+            now = time.perf_counter()
+            while self.position < len(self.frames) and self.start_ts + self.frames[self.position].timestamp <= now:
+                frame = self.frames[self.position]
+                self.position = self.position + 1
+            delay = self.start_ts + frame.timestamp - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        users = frame.users
+        if self.user_count is not None and users:
+            users = []
+            # Clones get their own silhouette too
+            user_map = frame.user_map.astype(np.uint16) if frame.user_map is not None else None
+            for copy in range(self.user_count):
+                user = frame.users[copy % len(frame.users)]
+                clone_index = copy // len(frame.users)
+                if clone_index == 0:
+                    users.append(user)
+                else:
+                    # Alternate clones to the right and left of the recorded user
+                    shift = REPLAY_CLONE_SPACING * ((clone_index + 1) // 2) * (1 if clone_index % 2 else -1)
+                    users.append(user.clone(user.id + 100 * clone_index, shift, self.params))
+                    if user_map is not None:
+                        clone_user_map(user_map, user.id, user.id + 100 * clone_index, shift // frame.user_map_step)
+            frame = RecordedFrame(frame.timestamp, frame.frameIndex, users, user_map, frame.user_map_step)
+        self.index_depth(users)
+        return frame
+
+class StartupTimer():
+    # Prints when each startup phase finished, relative to process start
+    def __init__(self, start_ts=STARTUP_TS):
+        self.start_ts = start_ts
+        self.lock = threading.Lock()
+        self.marks = set()
+
+    def elapsed_ms(self, ts=None):
+        return 1000 * ((ts if ts is not None else time.perf_counter()) - self.start_ts)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start_ts = time.perf_counter()
+        yield
+        end_ts = time.perf_counter()
+        print('startup: {} took {:.0f} ms, done at {:.0f} ms'.format(name, 1000 * (end_ts - start_ts), self.elapsed_ms(end_ts)))
+
+    def mark(self, name):
+        with self.lock:
+            if name in self.marks:
+                return
+            self.marks.add(name)
+        print('startup: {} at {:.0f} ms'.format(name, self.elapsed_ms()))
+
+class SkeletonAtlas():
+    # Every image in skeleton-images/ is decoded once, in parallel, and packed into a single
+    # display-format surface that all body parts of all users share
+    def __init__(self, startup_timer, directory='skeleton-images'):
+        self.startup_timer = startup_timer
+        self.filenames = {os.path.splitext(os.path.basename(f))[0]: f for f in glob.glob(os.path.join(directory, '*.png'))}
+        self.surface = None
+        self.rects = {}
+        self.images = {}
+        self.mirrored_images = {}
+        self.error = None
+        # Cleared when there is no display surface to convert to, as with the texture backend
+        self.convert = True
+        self.display_ready = threading.Event()
+        self.ready = threading.Event()
+        self.thread = threading.Thread(target=self.build, name='skeleton-atlas', daemon=True)
+        self.thread.start()
+
+    def build(self):
+        try:
+            with self.startup_timer.phase('decoding skeleton images'):
+                with concurrent.futures.ThreadPoolExecutor(ASSET_LOADER_THREADS) as pool:
+                    names = list(self.filenames)
+                    decoded = dict(zip(names, pool.map(pygame.image.load, [self.filenames[n] for n in names])))
+            # Converting to the display format needs the display mode to be set
+            self.display_ready.wait()
+            with self.startup_timer.phase('packing skeleton atlas'):
+                self.pack(decoded)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.ready.set()
+
+    def pack(self, decoded):
+        # Simple shelf packing, tallest images first
+        x = y = shelf_height = 0
+        for name in sorted(decoded, key=lambda n: -decoded[n].get_height()):
+            width, height = decoded[name].get_size()
+            if x + width > ATLAS_WIDTH and x > 0:
+                x = 0
+                y = y + shelf_height + ATLAS_PADDING
+                shelf_height = 0
+            self.rects[name] = pygame.Rect(x, y, width, height)
+            x = x + width + ATLAS_PADDING
+            shelf_height = max(shelf_height, height)
+        width = max([rect.right for rect in self.rects.values()] + [1])
+        surface = pygame.Surface((width, max(1, y + shelf_height)), pygame.SRCALPHA)
+        if self.convert:
+            surface = surface.convert_alpha()
+        surface.fill((0, 0, 0, 0))
+        for name, rect in self.rects.items():
+            # Copies the pixels exactly, since the atlas starts out fully transparent
+            surface.blit(decoded[name], rect, special_flags=pygame.BLEND_RGBA_MAX)
+        self.surface = surface
+        self.images = {name: surface.subsurface(rect) for name, rect in self.rects.items()}
+
+    def image(self, name, mirrored=False):
+        self.ready.wait()
+        if self.error is not None:
+            raise self.error
+        if not mirrored:
+            return self.images[name]
+        if name not in self.mirrored_images:
+            self.mirrored_images[name] = pygame.transform.flip(self.images[name], True, False)
+        return self.mirrored_images[name]
+
+class SpriteCache():
+    def __init__(self, scale_step=SPRITE_CACHE_SCALE_STEP, angle_step=SPRITE_CACHE_ANGLE_STEP,
+                 max_bytes=SPRITE_CACHE_MAX_BYTES, smooth=SPRITE_CACHE_SMOOTH):
+        self.scale_step = scale_step
+        self.angle_step = angle_step
+        self.angle_buckets = max(1, int(round(360 / angle_step)))
+        self.max_bytes = max_bytes
+        self.smooth = smooth
+        self.entries = collections.OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def quantize_all(self, scale, angle):
+        # Cache buckets of arrays of scales and angles
+        scale_bucket = np.rint(scale / self.scale_step).astype(int)
+        angle_bucket = np.rint(angle / self.angle_step).astype(int) % self.angle_buckets
+        return scale_bucket, angle_bucket
+
+    def set_quality(self, scale_step, angle_step, smooth):
+        # Entries of other settings stay cached until evicted, for when quality comes back
+        self.scale_step = scale_step
+        self.angle_step = angle_step
+        self.angle_buckets = max(1, int(round(360 / angle_step)))
+        self.smooth = smooth
+
+    def lookup(self, part, scale_bucket, angle_bucket):
+        key = (part.name, self.scale_step, self.angle_step, self.smooth, scale_bucket, angle_bucket)
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+        self.misses += 1
+        entry = self.render(part, scale_bucket * self.scale_step, angle_bucket * self.angle_step)
+        self.put(key, entry)
+        return entry
+
+    def entry_size(self, entry):
+        image = entry[0]
+        return image.get_pitch() * image.get_height() if image is not None else 0
+
+    def put(self, key, entry):
+        self.entries[key] = entry
+        self.bytes += self.entry_size(entry)
+        while self.bytes > self.max_bytes and len(self.entries) > 1:
+            _, old_entry = self.entries.popitem(last=False)
+            self.bytes -= self.entry_size(old_entry)
+            self.evictions += 1
+
+    def render(self, part, scale, angle):
+        # Returns the transformed image and the offset of its top left corner from the pivot joint
+        width_scaled = int(part.rect_orig[2] * scale)
+        height_scaled = int(part.rect_orig[3] * scale)
+        if width_scaled <= 0 or height_scaled <= 0:
+            return (None, (0, 0))
+        if self.smooth:
+            scaled_image = pygame.transform.smoothscale(part.image_orig, (width_scaled, height_scaled))
+        else:
+            scaled_image = pygame.transform.scale(part.image_orig, (width_scaled, height_scaled))
+        origin = (part.joint_coords[0][0] * scale, part.joint_coords[0][1] * scale)
+        offset = part.get_rotated_offset(scaled_image, origin, angle)
+        return (pygame.transform.rotate(scaled_image, angle), offset)
+
+    def prefill(self, parts, scales=SPRITE_CACHE_PREFILL_SCALES):
+        first = int(math.ceil(scales[0] / self.scale_step))
+        last = int(math.floor(scales[1] / self.scale_step))
+        for part in parts:
+            for scale_bucket in range(first, last + 1):
+                for angle_bucket in range(self.angle_buckets):
+                    key = (part.name, self.scale_step, self.angle_step, self.smooth, scale_bucket, angle_bucket)
+                    if key in self.entries:
+                        continue
+                    entry = self.render(part, scale_bucket * self.scale_step, angle_bucket * self.angle_step)
+                    if self.bytes + self.entry_size(entry) > self.max_bytes:
+                        return
+                    self.put(key, entry)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        hit_rate = 100 * self.hits / lookups if lookups else 0
+        return 'sprite cache: {} hits, {} misses ({:.1f}% hit rate), {} entries, {:.1f} MB, {} evictions'.format(
+            self.hits, self.misses, hit_rate, len(self.entries), self.bytes / (1024 * 1024), self.evictions)
+
+class PartAsset():
+    # Everything about a body part that doesn't depend on the user, shared by every user's BodyPart
+    def __init__(self, name, joint_coords, joint_indices, image, mirrored=False):
+        self.name = name
+        # Rig joints
+        self.joint_indices = joint_indices
+
+        # Already flipped by the atlas when mirrored
+        self.image_orig = image
         self.rect_orig = self.image_orig.get_rect()
-        self.image = self.image_orig
-        self.rect = self.image.get_rect()
+        if mirrored:
+            # Joints are mirrored on screen, so the image's joint coordinates are too
+            joint_coords = tuple((self.rect_orig[2] - x, y) for (x, y) in joint_coords)
+        self.joint_coords = joint_coords
+
+        joint_vector = (joint_coords[0][0] - joint_coords[1][0], joint_coords[0][1] - joint_coords[1][1])
+        self.joint_length = math.sqrt(sum(v**2 for v in joint_vector))
+        self.angle_orig = self.get_angle(joint_coords[0][0], joint_coords[0][1], joint_coords[1][0], joint_coords[1][1])
 
     def get_angle(self, x1, y1, x2, y2):
         theta = math.atan2(y2 - y1, x2 - x1)
@@ -118,7 +1027,7 @@ class BodyPart(pygame.sprite.Sprite):
         angle = 360 - (theta * 360 / (2 * math.pi) - 90)
         return angle
 
-    def get_rotated_origin(self, image, pos, originPos, angle):
+    def get_rotated_offset(self, image, originPos, angle):
         # see: https://stackoverflow.com/questions/4183208/how-do-i-rotate-an-image-around-its-center-using-pygame
 
         # calcaulate the axis aligned bounding box of the rotated image
@@ -133,125 +1042,670 @@ class BodyPart(pygame.sprite.Sprite):
         pivot_rotate = pivot.rotate(angle)
         pivot_move   = pivot_rotate - pivot
 
-        # calculate the upper left origin of the rotated image
-        origin = (pos[0] - originPos[0] + min_box[0] - pivot_move[0], pos[1] - originPos[1] - max_box[1] + pivot_move[1])
-        origin_int = (int(origin[0]), int(origin[1]))
-        return origin_int
-
-    def update(self, user_tracker, user):
-        j1confident = False
-        j2confident = False
-        if len(self.joints) == 2:
-            if type(self.joints[0]) is tuple:
-                j1a = user.skeleton.joints[self.joints[0][0]]
-                j1b = user.skeleton.joints[self.joints[0][1]]
-                (x1a, y1a) = user_tracker.convert_joint_coordinates_to_depth(j1a.position.x, j1a.position.y, j1a.position.z)
-                (x1b, y1b) = user_tracker.convert_joint_coordinates_to_depth(j1b.position.x, j1b.position.y, j1b.position.z)
-                (x1, y1) = (x1a + (x1b - x1a) / 2, y1a + (y1b - y1a) / 2)
-                if (0.4 < j1a.positionConfidence and 0.4 < j1b.positionConfidence):
-                    j1confident = True
-            else :
-                j1 = user.skeleton.joints[self.joints[0]]
-                (x1, y1) = user_tracker.convert_joint_coordinates_to_depth(j1.position.x, j1.position.y, j1.position.z)
-                if (0.4 < j1.positionConfidence):
-                    j1confident = True
-            if type(self.joints[1]) is tuple:
-                j2a = user.skeleton.joints[self.joints[1][0]]
-                j2b = user.skeleton.joints[self.joints[1][1]]
-                (x2a, y2a) = user_tracker.convert_joint_coordinates_to_depth(j2a.position.x, j2a.position.y, j2a.position.z)
-                (x2b, y2b) = user_tracker.convert_joint_coordinates_to_depth(j2b.position.x, j2b.position.y, j2b.position.z)
-                (x2, y2) = (x2a + (x2b - x2a) / 2, y2a + (y2b - y2a) / 2)
-                if (0.4 < j2a.positionConfidence and 0.4 < j2b.positionConfidence):
-                    j2confident = True
-            else :
-                j2 = user.skeleton.joints[self.joints[1]]
-                (x2, y2) = user_tracker.convert_joint_coordinates_to_depth(j2.position.x, j2.position.y, j2.position.z)
-                if (0.4 < j2.positionConfidence):
-                    j2confident = True
-        if j1confident or j2confident:
-            self.x1_last = x1
-            self.y1_last = y1
-            self.x2_last = x2
-            self.y2_last = y2
-            joint_vector = (x1 - x2, y1 - y2)
-            joint_length = math.sqrt(sum(v**2 for v in joint_vector))
-            scale = joint_length / self.joint_length
-            joint_angle = self.get_angle(x1, y1, x2, y2)
-            angle = joint_angle - self.angle_orig
-
-            width_scaled = int(self.rect_orig[2] * scale)
-            height_scaled = int(self.rect_orig[3] * scale)
-            if width_scaled > 0 and height_scaled > 0:
-                scaled_image = pygame.transform.smoothscale(self.image_orig, (width_scaled, height_scaled))
-                origin = (self.joint_coords[0][0] * scale, self.joint_coords[0][1] * scale)
-                rotated_origin = self.get_rotated_origin(scaled_image, (x1, y1), origin, angle)
-                self.image = pygame.transform.rotate(scaled_image, angle)
-                self.rect = self.image.get_rect()
-                self.rect.x = rotated_origin[0] + DEPTH_SPACE_X_ADJUST
-                self.rect.y = rotated_origin[1] + DEPTH_SPACE_Y_ADJUST
+        # calculate the upper left origin of the rotated image relative to the pivot
+        offset = (-originPos[0] + min_box[0] - pivot_move[0], -originPos[1] - max_box[1] + pivot_move[1])
+        return offset
+
+class BodyPart(pygame.sprite.Sprite):
+    # A user's pose of a part: just the transformed image and where it goes, set by PoseEngine
+    def __init__(self, asset):
+        pygame.sprite.Sprite.__init__(self)
+        self.asset = asset
+        self.image = asset.image_orig
+        self.rect = self.image.get_rect()
+        # Destination rectangle, angle and rotation origin, for the texture backend
+        self.quad = None
+
+class PoseEngine():
+    # Solves the angle, scale and blit position of every part of every user in one NumPy pass,
+    # leaving only the image lookups and sprite assignments to Python
+    def __init__(self, assets, sprite_cache=None):
+        self.sprite_cache = sprite_cache
+        # Used without the sprite cache
+        self.smooth = True
+        self.joint_indices = np.array([asset.joint_indices for asset in assets])
+        self.joint_length = np.array([asset.joint_length for asset in assets])
+        self.angle_orig = np.array([asset.angle_orig for asset in assets])
+        self.origin = np.array([asset.joint_coords[0] for asset in assets], dtype=np.float64)
+        self.size = np.array([asset.rect_orig.size for asset in assets], dtype=np.float64)
+
+    def solve(self, screen, confidence):
+        # Takes (users, joints) screen positions and confidences, returns (users, parts) arrays.
+        # Same math as PartAsset.get_angle, relative to the pivot joint.
+        pivot = screen[:, self.joint_indices[:, 0]]
+        end = screen[:, self.joint_indices[:, 1]]
+        visible = (confidence[:, self.joint_indices] > JOINT_CONFIDENCE_THRESHOLD).any(axis=2)
+        delta = pivot - end
+        scale = np.sqrt(delta[..., 0] ** 2 + delta[..., 1] ** 2) / self.joint_length
+        theta = np.arctan2(-delta[..., 1], -delta[..., 0])
+        theta = np.where(theta < 0, 2 * math.pi + theta, theta)
+        angle = 360 - (theta * 360 / (2 * math.pi) - 90) - self.angle_orig
+        return visible, pivot, scale, angle
+
+    def rotated_offset(self, scale, angle):
+        # Same as PartAsset.get_rotated_offset for every part at once
+        width = np.trunc(self.size[:, 0] * scale)
+        height = np.trunc(self.size[:, 1] * scale)
+        origin_x = self.origin[:, 0] * scale
+        origin_y = self.origin[:, 1] * scale
+        cos = np.cos(np.radians(angle))
+        sin = np.sin(np.radians(angle))
+        # Corners (0, 0), (w, 0), (w, -h) and (0, -h) rotated
+        corners_x = np.stack((np.zeros_like(width), width * cos, width * cos + height * sin, height * sin))
+        corners_y = np.stack((np.zeros_like(width), width * sin, width * sin - height * cos, -height * cos))
+        pivot_move_x = origin_x * cos + origin_y * sin - origin_x
+        pivot_move_y = origin_x * sin - origin_y * cos + origin_y
+        offset_x = -origin_x + corners_x.min(axis=0) - pivot_move_x
+        offset_y = -origin_y - corners_y.max(axis=0) + pivot_move_y
+        return np.stack((offset_x, offset_y), axis=-1), width, height
+
+    def update(self, groups, screen, confidence):
+        # groups hold each user's BodyParts in asset order, rows of screen and confidence match groups.
+        # Parts without a confident joint keep their last pose.
+        visible, pivot, scale, angle = self.solve(screen, confidence)
+        if self.sprite_cache is not None:
+            scale_bucket, angle_bucket = self.sprite_cache.quantize_all(scale, angle)
+            rows = zip(groups, visible.tolist(), pivot.tolist(), scale_bucket.tolist(), angle_bucket.tolist())
+            for group, visible_row, pivot_row, scale_row, angle_row in rows:
+                for sprite, part_visible, (x1, y1), scale_bucket, angle_bucket in zip(
+                        group.sprites(), visible_row, pivot_row, scale_row, angle_row):
+                    if not part_visible:
+                        continue
+                    image, offset = self.sprite_cache.lookup(sprite.asset, scale_bucket, angle_bucket)
+                    if image is not None:
+                        sprite.image = image
+                        sprite.rect = image.get_rect(topleft=(int(x1 + offset[0]), int(y1 + offset[1])))
+            return
+
+        offset, width, height = self.rotated_offset(scale, angle)
+        # Truncated toward zero like the unbatched path
+        position = np.trunc(pivot + offset).astype(int)
+        rows = zip(groups, visible.tolist(), position.tolist(), scale.tolist(), angle.tolist(),
+                   width.astype(int).tolist(), height.astype(int).tolist())
+        for group, visible_row, position_row, scale_row, angle_row, width_row, height_row in rows:
+            for sprite, part_visible, topleft, scale, angle, width_scaled, height_scaled in zip(
+                    group.sprites(), visible_row, position_row, scale_row, angle_row, width_row, height_row):
+                if not part_visible or width_scaled <= 0 or height_scaled <= 0:
+                    continue
+                transform = pygame.transform.smoothscale if self.smooth else pygame.transform.scale
+                scaled_image = transform(sprite.asset.image_orig, (width_scaled, height_scaled))
+                sprite.image = pygame.transform.rotate(scaled_image, angle)
+                sprite.rect = sprite.image.get_rect(topleft=topleft)
+
+    def update_quads(self, groups, screen, confidence):
+        # For TextureCompositor: each part's atlas region is stretched into a rectangle placing
+        # its pivot joint on the pivot, and rotated around that joint
+        visible, pivot, scale, angle = self.solve(screen, confidence)
+        width = self.size[:, 0] * scale
+        height = self.size[:, 1] * scale
+        origin = self.origin * scale[..., None]
+        topleft = pivot - origin
+        rows = zip(groups, visible.tolist(), topleft.tolist(), width.tolist(), height.tolist(), origin.tolist(), angle.tolist())
+        for group, visible_row, topleft_row, width_row, height_row, origin_row, angle_row in rows:
+            for sprite, part_visible, (x, y), width_scaled, height_scaled, origin, angle in zip(
+                    group.sprites(), visible_row, topleft_row, width_row, height_row, origin_row, angle_row):
+                if not part_visible or width_scaled < 1 or height_scaled < 1:
+                    continue
+                # pygame rotates counterclockwise, SDL clockwise
+                sprite.quad = ((x, y, width_scaled, height_scaled), -angle, origin)
+
+class SilhouetteLayer():
+    # A translucent, blurred silhouette of the tracked users. The user map is processed with array
+    # operations at its own small size and scaled up to the display once per tracker frame.
+    def __init__(self, color=SILHOUETTE_COLOR, alpha=SILHOUETTE_ALPHA, blur=SILHOUETTE_BLUR):
+        self.color = color
+        self.alpha = alpha
+        self.blur = blur
+        self.scale = 1
+        self.margin = 0
+        self.width = 0
+        self.mirrored = False
+        self.image = None
+        self.rect = None
+
+    def set_display_transform(self, scale, margin, width, mirrored):
+        self.scale = scale
+        self.margin = margin
+        self.width = width
+        self.mirrored = mirrored
+
+    def update(self, user_map, step, user_ids):
+        self.image = None
+        if user_map is None or not user_ids:
+            return
+        mask = np.isin(user_map, user_ids)
+        rows = np.flatnonzero(mask.any(axis=1))
+        columns = np.flatnonzero(mask.any(axis=0))
+        if not rows.size:
+            return
+        # Only the area around the users is blurred and scaled, with room for the blur to spread
+        height, width = mask.shape
+        top, bottom = max(0, rows[0] - self.blur), min(height, rows[-1] + self.blur + 1)
+        left, right = max(0, columns[0] - self.blur), min(width, columns[-1] + self.blur + 1)
+        mask = mask[top:bottom, left:right].astype(np.float32)
+        if self.blur:
+            mask = box_blur(mask, self.blur)
+        surface = pygame.Surface((right - left, bottom - top), pygame.SRCALPHA)
+        surface.fill(self.color)
+        # Surface arrays are indexed x first
+        alpha = pygame.surfarray.pixels_alpha(surface)
+        alpha[...] = (mask.T[::-1] if self.mirrored else mask.T) * self.alpha
+        del alpha
+        size = (round((right - left) * step * self.scale), round((bottom - top) * step * self.scale))
+        self.image = pygame.transform.smoothscale(surface, size)
+        if self.mirrored:
+            x = self.margin + self.width - (DEPTH_SPACE_X_ADJUST + right * step) * self.scale
+        else:
+            x = self.margin + (DEPTH_SPACE_X_ADJUST + left * step) * self.scale
+        self.rect = pygame.Rect(round(x), round((DEPTH_SPACE_Y_ADJUST + top * step) * self.scale), *size)
+
+    def draw(self, surface):
+        if self.image is not None:
+            surface.blit(self.image, self.rect)
+
+class TextureCompositor():
+    # Draws through SDL's renderer instead of onto a display surface. Body parts are drawn from one
+    # atlas texture, with scaling, rotation, mirroring and alpha as draw parameters. Other images
+    # are uploaded once per surface. Stands in for the display surface for the idle images,
+    # message and overlay, which only use get_size, fill and blit.
+    def __init__(self, size, full_screen, atlas, cache_size=TEXTURE_CACHE_SIZE):
+        # Experimental in pygame 2, so only needed when this backend is used
+        from pygame._sdl2 import video
+        self.video = video
+        # Filter scaled textures like smoothscale does, instead of picking the nearest pixels
+        os.environ.setdefault('SDL_RENDER_SCALE_QUALITY', 'linear')
+        self.window = video.Window('Kinect halloween skeleton', size=size, fullscreen_desktop=full_screen)
+        self.renderer = video.Renderer(self.window)
+        self.atlas = atlas
+        self.atlas_texture = None
+        self.cache_size = cache_size
+        self.textures = collections.OrderedDict()
+
+    def get_size(self):
+        return tuple(self.window.size)
+
+    def fill(self, color, rect=None):
+        self.renderer.draw_color = pygame.Color(color)
+        if rect is None:
+            self.renderer.clear()
+            return pygame.Rect((0, 0), self.get_size())
+        self.renderer.fill_rect(rect)
+        return pygame.Rect(rect)
+
+    def texture(self, surface):
+        # Surfaces are keyed by identity, the images drawn here are never changed in place
+        key = id(surface)
+        entry = self.textures.get(key)
+        if entry is not None and entry[0] is surface:
+            self.textures.move_to_end(key)
+            return entry[1]
+        texture = self.video.Texture.from_surface(self.renderer, surface)
+        self.textures[key] = (surface, texture)
+        while len(self.textures) > self.cache_size:
+            self.textures.popitem(last=False)
+        return texture
+
+    def blit(self, surface, dest):
+        texture = self.texture(surface)
+        alpha = surface.get_alpha()
+        texture.alpha = alpha if alpha is not None else 255
+        # Blending is only needed for translucent images, copying is cheaper
+        translucent = alpha is not None or surface.get_flags() & pygame.SRCALPHA
+        texture.blend_mode = 1 if translucent else 0
+        rect = pygame.Rect(dest[0], dest[1], surface.get_width(), surface.get_height())
+        texture.draw(dstrect=rect)
+        return rect
+
+    def draw_parts(self, groups, clip_rect):
+        if not groups:
+            return
+        if self.atlas_texture is None:
+            self.atlas_texture = self.video.Texture.from_surface(self.renderer, self.atlas.surface)
+            self.atlas_texture.blend_mode = 1
+        # The viewport clips to the skeleton area, but also moves the origin there
+        self.renderer.set_viewport(clip_rect)
+        for group in groups:
+            for sprite in group:
+                if sprite.quad is None:
+                    continue
+                (x, y, width, height), angle, origin = sprite.quad
+                self.atlas_texture.draw(srcrect=self.atlas.rects[sprite.asset.name],
+                                        dstrect=(x - clip_rect.x, y - clip_rect.y, width, height),
+                                        angle=angle, origin=origin, flip_x=MIRRORED)
+        self.renderer.set_viewport(None)
+
+    def present(self):
+        self.renderer.present()
+
+def render_idle_effect(image, effect, frame_count):
+    # Renders the frames of an idle image effect with whole-image NumPy operations
+    params = IDLE_EFFECTS[effect]
+    width, height = image.get_size()
+    if effect == 'zoom':
+        frames = []
+        for i in range(frame_count):
+            zoom = 1 + (params['zoom'] - 1) * i / (frame_count - 1)
+            crop_width, crop_height = round(width / zoom), round(height / zoom)
+            crop = image.subsurface(((width - crop_width) // 2, (height - crop_height) // 2, crop_width, crop_height))
+            frames.append(pygame.transform.smoothscale(crop, (width, height)))
+        return frames
+
+    pixels = pygame.surfarray.array3d(image)
+    x = np.arange(width, dtype=np.float32)[:, np.newaxis]
+    y = np.arange(height, dtype=np.float32)[np.newaxis, :]
+    if effect == 'wave':
+        # Rows shift sideways along a sine wave that travels down the image over one period
+        amplitude = params['amplitude'] * height
+        wavelength = params['wavelength'] * height
+        phases = 2 * math.pi * np.arange(frame_count) / frame_count
+        arrays = []
+        for phase in phases:
+            shift = np.rint(amplitude * np.sin(2 * np.pi * y / wavelength - phase)).astype(np.intp)
+            xs = np.clip(x.astype(np.intp) - shift, 0, width - 1)
+            arrays.append(pixels[xs, y.astype(np.intp)])
+    elif effect == 'twist':
+        # Swirls around the center, winding up and back over the time the image is shown
+        dx = x - width / 2
+        dy = y - height / 2
+        radius = np.hypot(dx, dy)
+        theta = np.arctan2(dy, dx)
+        weight = np.clip(1 - radius / (params['radius'] * height), 0, 1) ** 2
+        arrays = []
+        for i in range(frame_count):
+            angle = math.radians(params['angle']) * math.sin(math.pi * i / (frame_count - 1))
+            twisted = theta + angle * weight
+            xs = np.clip(np.rint(width / 2 + radius * np.cos(twisted)), 0, width - 1).astype(np.intp)
+            ys = np.clip(np.rint(height / 2 + radius * np.sin(twisted)), 0, height - 1).astype(np.intp)
+            arrays.append(pixels[xs, ys])
+    elif effect == 'color':
+        # Rotates the hue around the gray axis through a full cycle
+        pixels = pixels.astype(np.float32)
+        arrays = []
+        for i in range(frame_count):
+            angle = 2 * math.pi * i / frame_count
+            cos, sin = math.cos(angle), math.sin(angle)
+            matrix = cos * np.eye(3) + (1 - cos) / 3 + sin / math.sqrt(3) * np.array(
+                [[0, -1, 1], [1, 0, -1], [-1, 1, 0]])
+            arrays.append(np.clip(pixels @ matrix.T.astype(np.float32), 0, 255).astype(np.uint8))
+    else:
+        return [image]
+
+    frames = []
+    for array in arrays:
+        frame = image.copy()
+        pygame.surfarray.blit_array(frame, array)
+        frames.append(frame)
+    return frames
+
+class IdleAnimation():
+    # The frames of an idle image effect, played back by time
+    def __init__(self, frames, effect):
+        self.frames = frames
+        self.effect = effect
+        self.period_s = IDLE_EFFECTS.get(effect, {}).get('period_s')
+        self.duration_s = IDLE_IMAGE_TIMEOUT_S + FADE_LENGTH_S
+
+    def get_size(self):
+        return self.frames[0].get_size()
+
+    def frames_at(self, elapsed_s):
+        # The frame before the elapsed time, the one after and how far along between them
+        count = len(self.frames)
+        if count == 1:
+            return self.frames[0], None, 0
+        if self.period_s:
+            position = elapsed_s / self.period_s % 1 * count
+            index = int(position) % count
+            return self.frames[index], self.frames[(index + 1) % count], position - int(position)
+        position = min(1, max(0, elapsed_s / self.duration_s)) * (count - 1)
+        index = min(int(position), count - 2)
+        return self.frames[index], self.frames[index + 1], position - index
 
 class IdleImage(pygame.sprite.Sprite):
     def __init__(self, filename):
         pygame.sprite.Sprite.__init__(self)
         self.filename = filename
-        self.image = pygame.image.load(filename)
-        self.rect = self.image.get_rect()
-        self.width = self.rect[2]
-        self.height = self.rect[3]
-        self.aspect_ratio = self.width / self.height
+        # Set from the IdleImageLoader while the image is shown, already scaled to the display
+        self.animation = None
+        self.shown_ts = None
+        self.rect = pygame.Rect(0, 0, 0, 0)
 
-    def draw(self, surface, position, alpha):
+    def draw(self, surface, position, alpha, curr_ts, blend=True):
         width_surface, height_surface = surface.get_size()
-        surface_aspect_ratio = width_surface / height_surface
+        width, height = self.animation.get_size()
+        width_margin = int((width_surface - width) / 2)
+        height_margin = int((height_surface - height) / 2)
+
+        self.rect = pygame.Rect(width_margin + position[0], height_margin + position[1], width, height)
+        frame, next_frame, fraction = self.animation.frames_at(curr_ts - self.shown_ts)
+        if not blend and fraction >= 0.5:
+            frame = next_frame
+        frame.set_alpha(alpha if alpha < 255 else None)
+        surface.blit(frame, self.rect)
+        # The next frame blended over the first one stands in for the frames in between
+        next_alpha = int(alpha * fraction)
+        if blend and next_frame is not None and next_alpha > 0:
+            next_frame.set_alpha(next_alpha)
+            surface.blit(next_frame, self.rect)
+
+class IdleImageLoader():
+    # Decodes idle images on a worker thread, converted to the display format and
+    # letterboxed to the display size, renders their effect frames and keeps only
+    # the most recently used few
+    def __init__(self, cache_size=IDLE_IMAGE_CACHE_SIZE):
+        # Decoding can start before the display is up, converting and scaling can't
+        self.size = None
+        self.convert = True
+        self.display_ready = threading.Event()
+        self.cache_size = cache_size
+        self.cache = collections.OrderedDict()
+        self.pending = set()
+        self.failed = set()
+        # Failed file names not yet dropped from the slideshow
+        self.failures = queue.Queue()
+        self.lock = threading.Lock()
+        self.requests = queue.Queue()
+        self.thread = threading.Thread(target=self.load_loop, name='idle-image-loader', daemon=True)
+        self.thread.start()
 
-        if surface_aspect_ratio > self.aspect_ratio:
+    def request(self, filename):
+        with self.lock:
+            if filename in self.cache or filename in self.pending or filename in self.failed:
+                return
+            self.pending.add(filename)
+        self.requests.put(filename)
+
+    def get(self, filename):
+        with self.lock:
+            animation = self.cache.get(filename)
+            if animation is not None:
+                self.cache.move_to_end(filename)
+            return animation
+
+    def set_display_size(self, size, convert=True):
+        # Without a display surface (texture backend) images are kept in their decoded format
+        self.size = size
+        self.convert = convert
+        self.display_ready.set()
+
+    def stop(self):
+        self.requests.put(None)
+
+    def load_loop(self):
+        while True:
+            filename = self.requests.get()
+            if filename is None:
+                return
+            try:
+                image = self.prepare(filename)
+            except Exception as e:
+                # Dropped from the slideshow, whether it's unreadable, gone or too thin to show
+                print('warning: unable to load {}: {}'.format(filename, e))
+                image = None
+            source = None
+            if image is not None:
+                effect = random.choice(list(IDLE_EFFECTS))
+                width, height = image.get_size()
+                frame_count = min(IDLE_EFFECT_FRAMES, IDLE_EFFECT_MAX_BYTES // (width * height * image.get_bytesize()))
+                if effect != 'none' and frame_count >= 2:
+                    # The effect is rendered from a copy, subsurfaces lock their parent and the render
+                    # loop can't blit a locked surface
+                    source = image.copy()
+            with self.lock:
+                self.pending.discard(filename)
+                if image is None:
+                    self.failed.add(filename)
+                    self.failures.put(filename)
+                    continue
+                # Rendering the effect takes longer than decoding, until it's done the image
+                # can be shown without one
+                self.cache[filename] = IdleAnimation([image], 'none')
+                while len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+
+            if source is None:
+                continue
+            try:
+                animation = IdleAnimation(render_idle_effect(source, effect, frame_count), effect)
+            except Exception as e:
+                print('warning: unable to render {} effect for {}: {}'.format(effect, filename, e))
+                continue
+            with self.lock:
+                # An image that is already showing keeps playing without the effect
+                if filename in self.cache:
+                    self.cache[filename] = animation
+
+    def prepare(self, filename):
+        image = pygame.image.load(filename)
+        self.display_ready.wait()
+        if self.convert:
+            image = image.convert()
+        width_image, height_image = image.get_size()
+        width_surface, height_surface = self.size
+        if width_surface / height_surface > width_image / height_image:
             height = height_surface
-            width = int(self.width * height_surface / self.height)
-            width_margin = int((width_surface - width) / 2)
-            height_margin = 0
+            width = int(width_image * height_surface / height_image)
         else:
             width = width_surface
-            height = int(self.height * width_surface / self.width)
-            width_margin = 0
-            height_margin = int((height_surface - height) / 2)
-
-        self.rect[0] = width_margin + position[0]
-        self.rect[1] = height_margin + position[1]
+            height = int(height_image * width_surface / width_image)
+        return pygame.transform.smoothscale(image, (width, height))
 
-        image_scaled  = pygame.transform.scale(self.image, (width, height))
-        image_scaled.set_alpha(alpha)
-        surface.blit(image_scaled, self.rect)
+class IntervalHistogram():
+    # Counts the samples of one stage since the last dump
+    edges = [edge / 1000 for edge in STATS_HISTOGRAM_MS]
+    percentile_edges = np.geomspace(1e-5, 10, int(math.log(1e6) / math.log(1 + STATS_PERCENTILE_STEP)) + 1).tolist()
 
-class HalloweenSkeleton():
     def __init__(self):
-        self.sprites_lists = {}
-        self.idle_image_sprites = None
-        self.kinect_initialized = False
-        self.last_user_ts = None
-        self.last_idle_image_ts = None
-        self.last_idle_sprite = None
-        self.curr_idle_sprite = None
-        self.idle_image_queue = []
-        self.idle_image_x = None
-        self.idle_image_y = None
-        self.idle_image_angle = None
-        self.joint_set = None
-        self.untracked_user = False
+        self.count = 0
+        self.max = 0
+        self.histogram = [0] * (len(self.edges) + 1)
+        self.buckets = [0] * (len(self.percentile_edges) + 1)
 
-    def get_angle(self, x1, y1, x2, y2):
-        return math.atan2(y2 - y1, x2 - x1)
+    def add(self, duration):
+        self.count += 1
+        self.max = max(self.max, duration)
+        self.histogram[bisect.bisect_left(self.edges, duration)] += 1
+        self.buckets[bisect.bisect_left(self.percentile_edges, duration)] += 1
 
-    def load_images(self, user_id):
-        self.sprites_lists[user_id] = pygame.sprite.Group()
-        for name, data in BODYPART_LIST.items():
-            sprite = BodyPart(name, data['joints'], data['coords'])
-            self.sprites_lists[user_id].add(sprite)
+    def percentile(self, percent):
+        # The upper edge of the bucket the sample falls in, at most the largest sample
+        rank = percent / 100 * (self.count - 1)
+        index = int(np.searchsorted(np.cumsum(self.buckets), rank, side='right'))
+        if index >= len(self.percentile_edges):
+            return self.max
+        return min(self.percentile_edges[index], self.max)
+
+class StageStats():
+    # Rolling samples per stage for the percentiles, plus histograms since the last dump
+    # once a StatsDumper is attached
+    def __init__(self, window=STATS_WINDOW):
+        self.window = window
+        self.samples = {}
+        self.intervals = None
+        self.interval_start_ts = time.perf_counter()
+        self.counts = collections.Counter()
+        self.lock = threading.Lock()
+
+    def add(self, stage, duration):
+        with self.lock:
+            if stage not in self.samples:
+                self.samples[stage] = collections.deque(maxlen=self.window)
+            self.samples[stage].append(duration)
+            self.counts[stage] += 1
+            if self.intervals is not None:
+                if stage not in self.intervals:
+                    self.intervals[stage] = IntervalHistogram()
+                self.intervals[stage].add(duration)
+
+    def percentile(self, stage, percent):
+        with self.lock:
+            samples = sorted(self.samples.get(stage, ()))
+        if not samples:
+            return 0
+        index = min(len(samples) - 1, int(round(percent / 100 * (len(samples) - 1))))
+        return samples[index]
+
+    def take_interval(self):
+        # Returns the histograms since the last call and how long that was, the first call
+        # starts collecting them
+        with self.lock:
+            intervals = self.intervals or {}
+            self.intervals = {}
+            start_ts = self.interval_start_ts
+            self.interval_start_ts = time.perf_counter()
+        return intervals, self.interval_start_ts - start_ts
+
+    def summary(self):
+        lines = []
+        # Other threads can add stages meanwhile
+        with self.lock:
+            stages = sorted(self.samples)
+        for stage in stages:
+            with self.lock:
+                samples = list(self.samples[stage])
+                count = self.counts[stage]
+            lines.append('{}: {} samples, avg {:.2f} ms, p95 {:.2f} ms, max {:.2f} ms'.format(
+                stage, count, 1000 * sum(samples) / len(samples),
+                1000 * self.percentile(stage, 95), 1000 * max(samples)))
+        return '\n'.join(lines)
+
+class StatsDumper():
+    # Appends the stats of every interval to a file, to look for stutter after a night's run
+    def __init__(self, stats, filename, interval_s=STATS_DUMP_INTERVAL_S):
+        self.stats = stats
+        self.filename = filename
+        self.csv = filename.lower().endswith('.csv')
+        self.interval_s = interval_s
+        self.next_dump_ts = time.perf_counter() + interval_s
+        stats.take_interval()
+
+    def poll(self):
+        if time.perf_counter() >= self.next_dump_ts:
+            self.dump()
+
+    def dump(self):
+        self.next_dump_ts = time.perf_counter() + self.interval_s
+        intervals, duration = self.stats.take_interval()
+        rows = []
+        for stage in sorted(intervals):
+            interval = intervals[stage]
+            p50, p95, p99 = (interval.percentile(percent) for percent in (50, 95, 99))
+            rows.append((stage, interval.count, 1000 * p50, 1000 * p95, 1000 * p99, 1000 * interval.max, interval.histogram))
+        timestamp = time.strftime('%Y-%m-%dT%H:%M:%S')
+        new_file = not os.path.exists(self.filename) or os.path.getsize(self.filename) == 0
+        with open(self.filename, 'a') as f:
+            if self.csv:
+                if new_file:
+                    buckets = ['le_{}ms'.format(edge) for edge in STATS_HISTOGRAM_MS] + ['gt_{}ms'.format(STATS_HISTOGRAM_MS[-1])]
+                    f.write(','.join(['time', 'interval_s', 'stage', 'count', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms'] + buckets) + '\n')
+                for stage, count, p50, p95, p99, max_ms, histogram in rows:
+                    f.write(','.join(['{}'.format(timestamp), '{:.1f}'.format(duration), stage, str(count)] +
+                                     ['{:.3f}'.format(v) for v in (p50, p95, p99, max_ms)] + [str(n) for n in histogram]) + '\n')
+            else:
+                f.write(json.dumps({
+                    'time': timestamp,
+                    'interval_s': round(duration, 1),
+                    'histogram_ms': STATS_HISTOGRAM_MS,
+                    'stages': {stage: {'count': count, 'p50_ms': round(p50, 3), 'p95_ms': round(p95, 3),
+                                       'p99_ms': round(p99, 3), 'max_ms': round(max_ms, 3), 'histogram': histogram}
+                               for stage, count, p50, p95, p99, max_ms, histogram in rows},
+                }) + '\n')
+
+class StatsOverlay():
+    # FPS, and optionally per-stage frame times, in the top left corner. The font is loaded once
+    # and the text only re-rendered every STATS_OVERLAY_REFRESH_S.
+    STAGES = ('events', 'capture.read', 'update', 'pose', 'draw', 'idle', 'message', 'flip', 'frame')
+
+    def __init__(self, stats, show_stages=False):
+        self.stats = stats
+        self.show_stages = show_stages
+        self.font = None
+        self.small_font = None
+        self.image = None
+        self.render_ts = None
+
+    def render(self, clock):
+        if self.font is None:
+            self.font = pygame.font.SysFont('Arial', 32)
+            self.small_font = pygame.font.SysFont('Arial', 20)
+        lines = [self.font.render(str(int(clock.get_fps())), 0, pygame.Color('white'))]
+        if self.show_stages:
+            for stage in self.STAGES:
+                if self.stats.counts[stage]:
+                    text = '{} {:.1f} / {:.1f} / {:.1f} ms'.format(stage, 1000 * self.stats.percentile(stage, 50),
+                                                                  1000 * self.stats.percentile(stage, 95),
+                                                                  1000 * self.stats.percentile(stage, 100))
+                    lines.append(self.small_font.render(text, 0, pygame.Color('white')))
+        image = pygame.Surface((max(line.get_width() for line in lines), sum(line.get_height() for line in lines)))
+        y = 0
+        for line in lines:
+            image.blit(line, (0, y))
+            y += line.get_height()
+        return image
+
+    def draw(self, clock, surface):
+        now = time.perf_counter()
+        if self.image is None or now >= self.render_ts + STATS_OVERLAY_REFRESH_S:
+            self.image = self.render(clock)
+            self.render_ts = now
+        return surface.blit(self.image, (0, 0))
+
+CapturedFrame = collections.namedtuple('CapturedFrame', ['index', 'timestamp', 'generation', 'user_tracker', 'ut_frame', 'read_s'])
+
+class LatestFrameBuffer():
+    def __init__(self, size=CAPTURE_BUFFER_SIZE, lockstep=False):
+        self.frames = collections.deque(maxlen=size)
+        self.condition = threading.Condition()
+        # In lockstep mode the producer waits for every frame to be consumed (used for benchmarks)
+        self.lockstep = lockstep
+        self.dropped = 0
+
+    def put(self, frame, stop_event=None):
+        with self.condition:
+            while self.lockstep and self.frames and not (stop_event and stop_event.is_set()):
+                self.condition.wait(0.1)
+            if len(self.frames) == self.frames.maxlen:
+                self.dropped += 1
+            self.frames.append(frame)
+            self.condition.notify_all()
+
+    def take_latest(self, timeout=None):
+        # Older frames are stale by the time we render, so skip straight to the newest
+        with self.condition:
+            if not self.frames and timeout:
+                self.condition.wait(timeout)
+            if not self.frames:
+                return None
+            frame = self.frames.pop()
+            self.dropped += len(self.frames)
+            self.frames.clear()
+            self.condition.notify_all()
+            return frame
+
+    def clear(self):
+        with self.condition:
+            self.frames.clear()
+            self.condition.notify_all()
+
+    def wait(self, timeout):
+        # Sleeps until a frame is available without taking it, returns whether there is one
+        with self.condition:
+            return bool(self.condition.wait_for(lambda: self.frames, timeout))
+
+class KinectDriver():
+    def __init__(self, replay_tracker=None):
+        self.replay_tracker = replay_tracker
+        self.kinect_initialized = False
 
     def init_kinect(self):
         if self.kinect_initialized:
             self.close_kinect()
             self.kinect_initialized = False
 
+        if self.replay_tracker is not None:
+            self.kinect_initialized = True
+            return None, self.replay_tracker
+
         try:
             openni2.initialize('../KinectLibs/OpenNI-Linux-x64-2.2/Redist')
             dev = openni2.Device.open_any()
@@ -271,156 +1725,758 @@ class HalloweenSkeleton():
         return dev, user_tracker
 
     def close_kinect(self):
-        nite2.unload()
-        openni2.unload()
+        if self.replay_tracker is None:
+            nite2.unload()
+            openni2.unload()
         self.kinect_initialized = False
 
-    def get_confidence(self, user):
-        if self.joint_set is None:
-            self.joint_set = set()
-            for name, data in BODYPART_LIST.items():
-                for joint in data['joints']:
-                    if type(joint) is tuple:
-                        for subjoint in joint:
-                            self.joint_set.add(subjoint)
-                    else:
-                        self.joint_set.add(joint)
-        total = 0
-        count = 0
-        for joint in self.joint_set:
-            j = user.skeleton.joints[joint]
-            total = total + j.positionConfidence
-            count = count + 1
-        confidence = total / count
-        return confidence
-
-    def draw_skeleton(self, surface, user_tracker, user):
-        if user.id not in self.sprites_lists:
-            self.load_images(user.id)
-        self.sprites_lists[user.id].update(user_tracker, user)
-        self.sprites_lists[user.id].draw(surface)
-        confidence = self.get_confidence(user)
-        return confidence
+    def print_device_info(self, dev):
+        dev_name = dev.get_device_info().name.decode('UTF-8')
+        print("Device Name: {}".format(dev_name))
+        use_kinect = False
+        if dev_name == 'Kinect':
+            use_kinect = True
+            print('using Kinect.')
+        (kinect_width, kinect_height) = CAPTURE_SIZE_KINECT if use_kinect else CAPTURE_SIZE_OTHERS
 
     def set_kinect_angle(self, angle):
         df = subprocess.Popen(['./kinect-tilt', str(angle)], stdout=subprocess.PIPE)
         output = df.communicate()[0].decode('utf-8')
         return output
 
+class TrackerCapture():
+    def __init__(self, driver, stats, startup_timer, recorder=None, lockstep=False, tilt_angle=None):
+        self.driver = driver
+        self.startup_timer = startup_timer
+        self.dev = None
+        self.user_tracker = None
+        self.stats = stats
+        self.tilt_angle = tilt_angle
+        self.recorder = recorder
+        self.buffer = LatestFrameBuffer(lockstep=lockstep)
+        # Held while NiTE frames are being used, so the driver isn't unloaded underneath them
+        self.driver_lock = threading.RLock()
+        self.generation = 0
+        self.frame_count = 0
+        self.last_frame = None
+        self.error = None
+        self.reset_requested = threading.Event()
+        self.stop_requested = threading.Event()
+        self.thread = threading.Thread(target=self.capture_loop, name='tracker-capture', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stop_requested.set()
+        self.thread.join(CAPTURE_JOIN_TIMEOUT_S)
+        if self.recorder is not None:
+            self.recorder.close()
+        with self.driver_lock:
+            if self.driver.kinect_initialized:
+                self.driver.close_kinect()
+
+    def summary(self):
+        return 'capture: {} frames read, {} dropped'.format(self.frame_count, self.buffer.dropped)
+
+    def child_cpu_time(self):
+        # The tracker runs in this process, its CPU time is already counted
+        return 0
+
+    def request_reset(self):
+        self.reset_requested.set()
+
+    def capture_loop(self):
+        try:
+            startup_timer = self.startup_timer
+            # Tilting and the driver both use the USB device, so they run one after the other,
+            # but off the render thread and in parallel with the display and asset loading
+            if self.tilt_angle is not None:
+                with startup_timer.phase('kinect tilt'):
+                    self.driver.set_kinect_angle(self.tilt_angle)
+            with startup_timer.phase('tracker init'):
+                with self.driver_lock:
+                    self.dev, self.user_tracker = self.driver.init_kinect()
+            if self.dev is not None:
+                self.driver.print_device_info(self.dev)
+            while not self.stop_requested.is_set():
+                if self.reset_requested.is_set():
+                    self.reset()
+                if not self.driver.kinect_initialized:
+                    with self.driver_lock:
+                        self.dev, self.user_tracker = self.driver.init_kinect()
+                start_ts = time.perf_counter()
+                ut_frame = self.user_tracker.read_frame()
+                read_ts = time.perf_counter()
+                self.stats.add('capture.read', read_ts - start_ts)
+                self.frame_count = self.frame_count + 1
+                if self.frame_count == 1:
+                    startup_timer.mark('first tracker frame')
+                for user in ut_frame.users:
+                    if user.is_new():
+                        print("{}: new human id:{} detected.".format(self.frame_count, user.id))
+                        self.user_tracker.start_skeleton_tracking(user.id)
+                if self.recorder is not None:
+                    self.recorder.write(ut_frame, self.user_tracker, read_ts)
+                self.last_frame = ut_frame
+                self.buffer.put(CapturedFrame(self.frame_count, read_ts, self.generation, self.user_tracker, ut_frame,
+                                              read_ts - start_ts), self.stop_requested)
+                if not ut_frame.users and TRACKER_IDLE_FPS and not self.buffer.lockstep:
+                    # Nobody in view, skip frames until the next idle read
+                    self.stop_requested.wait(max(0, start_ts + 1 / TRACKER_IDLE_FPS - time.perf_counter()))
+        except Exception as e:
+            # Surfaced by whoever consumes the frames: the render loop, or the tracker process
+            # which then exits and gets restarted
+            self.error = e
+
+    def reset(self):
+        with self.driver_lock:
+            self.buffer.clear()
+            self.generation = self.generation + 1
+            if self.last_frame is not None:
+                for user in self.last_frame.users:
+                    self.user_tracker.stop_skeleton_tracking(user.id)
+                self.last_frame = None
+            self.driver.close_kinect()
+            self.reset_requested.clear()
+
+TRACKER_FRAME = struct.Struct('<Idd')
+
+def run_tracker_process(conn, replay_tracker, tilt_angle, startup_ts, user_maps):
+    # Child side of TrackerSupervisor: reads the tracker on a TrackerCapture thread and sends
+    # the projection header (whenever the driver was reinitialized) and every frame to the parent,
+    # with its user map if the parent draws silhouettes or records.
+    # Frames are tagged with the number of resets done, so the parent can drop the stale ones,
+    # how long read_frame took and the child's CPU time so far.
+    capture = TrackerCapture(KinectDriver(replay_tracker), StageStats(), StartupTimer(startup_ts), tilt_angle=tilt_angle)
+    capture.start()
+    projection = JointProjection()
+    try:
+        while True:
+            while conn.poll():
+                command = conn.recv_bytes()
+                if command == b'stop':
+                    return
+                if command == b'reset':
+                    capture.request_reset()
+            if capture.error is not None:
+                raise capture.error
+            captured = capture.buffer.take_latest(TRACKER_POLL_S)
+            if captured is None:
+                continue
+            with capture.driver_lock:
+                if captured.generation != capture.generation:
+                    continue
+                if captured.user_tracker is not projection.user_tracker:
+                    projection.calibrate(captured.user_tracker)
+                    conn.send_bytes(b'H' + encode_header(projection))
+                data = encode_frame(captured.ut_frame, captured.user_tracker, projection, captured.timestamp, captured.index,
+                                    user_maps)
+            conn.send_bytes(b'F' + TRACKER_FRAME.pack(captured.generation, captured.read_s, time.process_time()) + data)
+    except (EOFError, BrokenPipeError):
+        # The parent is gone
+        pass
+    finally:
+        capture.stop()
+
+class TrackerSupervisor():
+    # Same interface as TrackerCapture, but the driver runs in a child process that is restarted
+    # in the background when it crashes or stops sending frames
+    def __init__(self, replay_tracker, stats, startup_timer, recorder=None, tilt_angle=None):
+        self.replay_tracker = replay_tracker
+        self.stats = stats
+        self.startup_timer = startup_timer
+        self.recorder = recorder
+        self.tilt_angle = tilt_angle
+        self.user_maps = SILHOUETTE_ENABLED or recorder is not None
+        # Spawned rather than forked, the display process has threads and SDL state the child mustn't inherit
+        self.context = multiprocessing.get_context('spawn')
+        self.process = None
+        self.conn = None
+        self.user_tracker = None
+        self.buffer = LatestFrameBuffer()
+        # Frames are decoded copies, the lock only keeps the generation check consistent with TrackerCapture
+        self.driver_lock = threading.RLock()
+        self.generation = 0
+        self.child_generation = 0
+        self.frame_count = 0
+        self.frame_count_at_start = 0
+        self.restarts = 0
+        # CPU time of the running child from its first frame to its last, and of the ones before it.
+        # Starting up is left out, it would all land on whichever display frame first hears from the child.
+        self.child_cpu_start_s = None
+        self.child_cpu_s = 0
+        self.earlier_children_cpu_s = 0
+        self.failed_ts = None
+        self.error = None
+        self.reset_requested = threading.Event()
+        self.stop_requested = threading.Event()
+        self.thread = threading.Thread(target=self.supervise_loop, name='tracker-supervisor', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stop_requested.set()
+        self.thread.join(TRACKER_STOP_TIMEOUT_S + CAPTURE_JOIN_TIMEOUT_S)
+        if self.recorder is not None:
+            self.recorder.close()
+
+    def request_reset(self):
+        with self.driver_lock:
+            self.buffer.clear()
+            self.generation = self.generation + 1
+        self.reset_requested.set()
+
+    def summary(self):
+        lines = ['capture: {} frames read, {} dropped'.format(self.frame_count, self.buffer.dropped)]
+        lines.append('tracker: {} restarts'.format(self.restarts))
+        if self.stats.counts['tracker.recovery']:
+            lines[-1] += ', recovery p50 {:.0f} ms, max {:.0f} ms'.format(
+                1000 * self.stats.percentile('tracker.recovery', 50), 1000 * self.stats.percentile('tracker.recovery', 100))
+        return '\n'.join(lines)
+
+    def start_child(self, tilt_angle):
+        self.conn, child_conn = self.context.Pipe()
+        self.process = self.context.Process(target=run_tracker_process, name='tracker', daemon=True,
+                                            args=(child_conn, self.replay_tracker, tilt_angle, self.startup_timer.start_ts,
+                                                  self.user_maps))
+        self.process.start()
+        child_conn.close()
+        self.user_tracker = None
+        self.child_generation = 0
+        self.earlier_children_cpu_s += self.child_cpu_s
+        self.child_cpu_start_s = None
+        self.child_cpu_s = 0
+
+    def child_cpu_time(self):
+        return self.earlier_children_cpu_s + self.child_cpu_s
+
+    def stop_child(self, graceful=True):
+        if graceful:
+            try:
+                self.conn.send_bytes(b'stop')
+            except OSError:
+                pass
+            self.process.join(TRACKER_STOP_TIMEOUT_S)
+        if self.process.is_alive():
+            # Hung in the driver
+            self.process.kill()
+            self.process.join()
+        self.conn.close()
+
+    def supervise_loop(self):
+        try:
+            self.supervise()
+        except Exception as e:
+            # Not something a restart fixes, e.g. a replay that can't be sent to the child or a failed
+            # recording write. Surfaced by the render loop, like an error on the capture thread.
+            self.error = e
+            if self.process is not None and self.process.is_alive():
+                self.process.kill()
+
+    def supervise(self):
+        tilt_angle = self.tilt_angle
+        failures = 0
+        while not self.stop_requested.is_set():
+            self.start_child(tilt_angle)
+            # The Kinect stays tilted, only the first child moves it
+            tilt_angle = None
+            reason = self.watch_child()
+            if reason is None:
+                self.stop_child()
+                break
+            if self.failed_ts is None:
+                self.failed_ts = time.perf_counter()
+            self.stop_child(graceful=False)
+            self.restarts = self.restarts + 1
+            with self.driver_lock:
+                self.buffer.clear()
+                self.generation = self.generation + 1
+            if self.frame_count_at_start == self.frame_count:
+                failures = failures + 1
+            else:
+                failures = 0
+            delay = min(TRACKER_RESTART_MAX_DELAY_S, TRACKER_RESTART_DELAY_S * 2 ** failures)
+            print('tracker: process {}, restarting in {:.1f} s'.format(reason, delay))
+            self.stop_requested.wait(delay)
+
+    def watch_child(self):
+        # Returns why the child has to be restarted, or None when stopping
+        self.frame_count_at_start = self.frame_count
+        timeout = TRACKER_START_TIMEOUT_S
+        last_message_ts = time.perf_counter()
+        while not self.stop_requested.is_set():
+            if self.reset_requested.is_set():
+                self.reset_requested.clear()
+                self.child_generation = self.child_generation + 1
+                # Reinitializing the driver takes about as long as starting it
+                timeout = TRACKER_START_TIMEOUT_S
+                last_message_ts = time.perf_counter()
+                try:
+                    self.conn.send_bytes(b'reset')
+                except OSError:
+                    return 'exited'
+            try:
+                if not self.conn.poll(TRACKER_POLL_S):
+                    if not self.process.is_alive():
+                        return 'exited with code {}'.format(self.process.exitcode)
+                    if time.perf_counter() - last_message_ts > timeout:
+                        return 'hung'
+                    continue
+                message = self.conn.recv_bytes()
+            except (EOFError, OSError):
+                return 'exited'
+            last_message_ts = time.perf_counter()
+            if message[:1] == b'H':
+                self.user_tracker = RecordedUserTracker(decode_header(message, 1))
+            elif message[:1] == b'F':
+                timeout = TRACKER_HANG_TIMEOUT_S
+                self.receive_frame(message, last_message_ts)
+        return None
+
+    def receive_frame(self, message, receive_ts):
+        generation, read_s, cpu_s = TRACKER_FRAME.unpack_from(message, 1)
+        if self.child_cpu_start_s is None:
+            self.child_cpu_start_s = cpu_s
+        self.child_cpu_s = cpu_s - self.child_cpu_start_s
+        if generation != self.child_generation:
+            return
+        self.stats.add('capture.read', read_s)
+        ut_frame, _ = decode_frame(message, 1 + TRACKER_FRAME.size)
+        self.user_tracker.index_depth(ut_frame.users)
+        # perf_counter is system wide, so the child's read time is comparable
+        self.stats.add('tracker.transfer', receive_ts - ut_frame.timestamp)
+        if self.failed_ts is not None:
+            recovery = receive_ts - self.failed_ts
+            self.stats.add('tracker.recovery', recovery)
+            print('tracker: recovered after {:.0f} ms'.format(1000 * recovery))
+            self.failed_ts = None
+        self.frame_count = self.frame_count + 1
+        if self.recorder is not None:
+            self.recorder.write(ut_frame, self.user_tracker, ut_frame.timestamp)
+        with self.driver_lock:
+            self.buffer.put(CapturedFrame(self.frame_count, ut_frame.timestamp, self.generation, self.user_tracker, ut_frame, read_s))
+
+class QualityGovernor():
+    def __init__(self, fps, levels=QUALITY_LEVELS):
+        self.budget_s = 1 / fps
+        self.levels = levels
+        self.level = 0
+        self.frame_times = collections.deque(maxlen=GOVERNOR_WINDOW)
+        self.changed_ts = -math.inf
+        self.headroom_since_ts = None
+        self.changes = 0
+
+    def observe(self, frame_s, now):
+        # Returns the new level when quality should change, otherwise None
+        if now < self.changed_ts + GOVERNOR_COOLDOWN_S:
+            # Sprite cache misses right after a change would make the new level look slower than it is
+            return None
+        self.frame_times.append(frame_s)
+        if len(self.frame_times) < self.frame_times.maxlen:
+            return None
+        frame_p90 = sorted(self.frame_times)[int(0.9 * (len(self.frame_times) - 1))]
+        if frame_p90 >= GOVERNOR_UPGRADE * self.budget_s:
+            self.headroom_since_ts = None
+        elif self.headroom_since_ts is None:
+            self.headroom_since_ts = now
+        if frame_p90 > GOVERNOR_DOWNGRADE * self.budget_s and self.level < len(self.levels) - 1:
+            return self.change(self.level + 1, frame_p90, now)
+        if (self.headroom_since_ts is not None and now >= self.headroom_since_ts + GOVERNOR_UPGRADE_HOLD_S and
+                self.level > 0):
+            return self.change(self.level - 1, frame_p90, now)
+        return None
+
+    def change(self, level, frame_p90, now):
+        print('quality: level {} -> {}, frame p90 {:.1f} ms of a {:.1f} ms budget'.format(
+            self.level, level, 1000 * frame_p90, 1000 * self.budget_s))
+        self.level = level
+        self.changes = self.changes + 1
+        self.changed_ts = now
+        self.headroom_since_ts = None
+        # Judge the new level on its own frames
+        self.frame_times.clear()
+        return level
+
+class HalloweenSkeleton():
+    def __init__(self, replay_tracker=None, record_filename=None, stats_filename=None):
+        self.replay_tracker = replay_tracker
+        self.record_filename = record_filename
+        self.startup_timer = StartupTimer()
+        self.atlas = SkeletonAtlas(self.startup_timer)
+        self.sprites_lists = {}
+        self.sprite_cache = SpriteCache() if SPRITE_CACHE_ENABLED else None
+        self.rig = Rig.load(RIG)
+        missing = [name for name in self.rig.part_names if name not in self.atlas.filenames]
+        if missing:
+            raise ValueError('rig {}: no skeleton images for {}'.format(RIG, ', '.join(missing)))
+        self.part_assets = None
+        self.pose_engine = None
+        self.joint_batch = JointBatch(self.rig)
+        self.idle_image_sprites = None
+        self.idle_image_loader = None
+        self.last_user_ts = None
+        self.last_idle_image_ts = None
+        self.last_idle_sprite = None
+        self.curr_idle_sprite = None
+        self.idle_image_queue = []
+        self.idle_image_x = None
+        self.idle_image_y = None
+        self.idle_image_angle = None
+        self.untracked_user = False
+        self.drawn_users = []
+        self.skeleton_rects = []
+        self.full_frame_pending = True
+        self.fps_rect = None
+        self.stats = StageStats()
+        self.stats_filename = stats_filename
+        self.stats_overlay = None
+        self.compositor = None
+        self.silhouette = SilhouetteLayer() if SILHOUETTE_ENABLED else None
+        self.quality = QUALITY_LEVELS[0]
+        self.last_processed_ts = None
+        # Busy time added to every frame (or every other load_period_s) to test the governor
+        self.synthetic_load_s = 0
+        self.load_period_s = None
+        self.message_font = None
+        self.message_image = None
+
+    def get_angle(self, x1, y1, x2, y2):
+        return math.atan2(y2 - y1, x2 - x1)
+
+    def get_part_assets(self):
+        if self.part_assets is None:
+            self.part_assets = []
+            for name, coords, joint_indices in zip(self.rig.part_names, self.rig.part_coords, self.rig.part_joints.tolist()):
+                self.part_assets.append(PartAsset(name, coords, joint_indices, self.atlas.image(name, MIRRORED), MIRRORED))
+            self.pose_engine = PoseEngine(self.part_assets, self.sprite_cache)
+            self.pose_engine.smooth = self.quality['smooth']
+            if SPRITE_CACHE_PREFILL and self.sprite_cache is not None:
+                self.sprite_cache.prefill(self.part_assets)
+        return self.part_assets
+
+    def load_images(self, user_id):
+        self.sprites_lists[user_id] = pygame.sprite.RenderUpdates()
+        for asset in self.get_part_assets():
+            self.sprites_lists[user_id].add(BodyPart(asset))
+
+    def evict_user(self, user_id):
+        # NiTE hands out a new id to every visitor, so per-user state must not outlive the user
+        group = self.sprites_lists.pop(user_id, None)
+        if group is not None:
+            # Sprites and groups reference each other, emptying frees them without waiting for the GC
+            group.empty()
+        if user_id in self.drawn_users:
+            self.drawn_users.remove(user_id)
+        self.joint_batch.evict(user_id)
+
+    def set_quality(self, quality):
+        self.quality = quality
+        if self.sprite_cache is not None:
+            self.sprite_cache.set_quality(quality['scale_step'], quality['angle_step'], quality['smooth'])
+        if self.pose_engine is not None:
+            self.pose_engine.smooth = quality['smooth']
+
+    def update_poses(self, target_ts):
+        # Poses are extrapolated for every rendered frame, not just the frames with new tracker data
+        stage_ts = time.perf_counter()
+        self.joint_batch.predict(target_ts)
+        self.get_part_assets()
+        groups = []
+        for user_id in self.joint_batch.user_ids:
+            if user_id not in self.sprites_lists:
+                self.load_images(user_id)
+            groups.append(self.sprites_lists[user_id])
+        if groups and self.compositor is not None:
+            self.pose_engine.update_quads(groups, self.joint_batch.screen_array, self.joint_batch.confidence_array)
+        elif groups:
+            self.pose_engine.update(groups, self.joint_batch.screen_array, self.joint_batch.confidence_array)
+        self.stats.add('pose', time.perf_counter() - stage_ts)
+
+    def draw_skeletons(self, surface, dirty=False):
+        # Returns the changed areas. In dirty mode the areas covered by body parts in the
+        # previous frame are cleared first, since the display isn't filled every frame.
+        rects = []
+        if dirty:
+            for rect in self.skeleton_rects:
+                rects.append(surface.fill((0, 0, 0), rect))
+        self.skeleton_rects = []
+        for user_id in self.drawn_users:
+            group = self.sprites_lists[user_id]
+            rects.extend(group.draw(surface))
+            self.skeleton_rects.extend(sprite.rect.copy() for sprite in group)
+        return rects
+
+    def process_frame(self, captured):
+        ut_frame = captured.ut_frame
+        user_tracker = captured.user_tracker
+        user_tracked = False
+        tracked_users = []
+        if ut_frame.users:
+            for user in ut_frame.users:
+                if user.is_new():
+                    # Skeleton tracking is started by the capture thread
+                    if not user_tracked:
+                        self.untracked_user = True
+                    self.last_user_ts = time.time()
+                elif (user.state == nite2.UserState.NITE_USER_STATE_VISIBLE and
+                      user.skeleton.state == nite2.SkeletonState.NITE_SKELETON_TRACKED):
+                    self.last_user_ts = time.time()
+                    tracked_users.append(user)
+                    self.untracked_user = False
+                    user_tracked = True
+                else:
+                    if not user_tracked:
+                        self.untracked_user = True
+        else:
+            self.untracked_user = False
+            self.last_user_ts = None
+
+        # Drop the state of users NiTE lost, including ones whose lost frame was skipped
+        present_ids = set(user.id for user in ut_frame.users if not user.is_lost())
+        for user_id in list(self.sprites_lists):
+            if user_id not in present_ids:
+                self.evict_user(user_id)
+
+        # Convert the joints of all tracked users in one batch, sprites are updated from the
+        # filtered poses in update_poses
+        self.joint_batch.update(user_tracker, tracked_users, captured.timestamp)
+        self.drawn_users = [user.id for user in tracked_users]
+
+        if self.silhouette is not None:
+            stage_ts = time.perf_counter()
+            self.silhouette.update(*read_user_map(ut_frame), self.drawn_users)
+            self.stats.add('silhouette', time.perf_counter() - stage_ts)
+
     '''
     @TODO
     * Add message when person is detect telling them to stand in front of screen
     * Figure out crash with bad magic
     * Overlap fade
-    * Have them move and zoom slightly while displayed
-    * Other effects: wave, twist, color cycle
     '''
-    def draw_idle_images(self, surface):
-        if self.idle_image_sprites is None:
-            self.idle_image_sprites = pygame.sprite.Group()
-            filenames = []
-            for extension in ('png', 'jpg', 'jpeg'):
-                filenames.extend(glob.glob('images-other/*.' + extension))
-            for filename in filenames:
-                sprite = IdleImage(filename)
-                self.idle_image_sprites.add(sprite)
+    def load_idle_images(self):
+        # Only the file names are read here, the first image starts decoding right away
+        self.idle_image_sprites = pygame.sprite.Group()
+        filenames = []
+        for extension in ('png', 'jpg', 'jpeg'):
+            filenames.extend(glob.glob('images-other/*.' + extension))
+        for filename in filenames:
+            sprite = IdleImage(filename)
+            self.idle_image_sprites.add(sprite)
+        self.idle_image_queue = self.idle_image_sprites.sprites()
+        random.shuffle(self.idle_image_queue)
+        self.idle_image_loader = IdleImageLoader()
+        if self.idle_image_queue:
+            self.idle_image_loader.request(self.idle_image_queue[-1].filename)
 
+    def draw_idle_images(self, surface):
+        # Images that failed to decode are dropped from the slideshow
+        while not self.idle_image_loader.failures.empty():
+            filename = self.idle_image_loader.failures.get()
+            for sprite in self.idle_image_sprites.sprites():
+                if sprite.filename == filename:
+                    sprite.kill()
+                    if sprite in self.idle_image_queue:
+                        self.idle_image_queue.remove(sprite)
         if len(self.idle_image_queue) == 0:
             self.idle_image_queue = self.idle_image_sprites.sprites()
             random.shuffle(self.idle_image_queue)
+        if len(self.idle_image_queue) == 0:
+            return
+        next_sprite = self.idle_image_queue[-1]
+        self.idle_image_loader.request(next_sprite.filename)
 
         curr_ts = time.time()
         if self.last_idle_image_ts is None or curr_ts > self.last_idle_image_ts + IDLE_IMAGE_TIMEOUT_S:
-            if self.idle_image_angle is not None:
-                self.idle_image_angle = (self.idle_image_angle + 90 + random.randint(0, 180)) % 360
-            else:
-                self.idle_image_angle = random.randint(0,359)
-            self.idle_image_direction = self.idle_image_angle * 2 * math.pi / 360
-            self.x_last = self.idle_image_x
-            self.y_last = self.idle_image_y
-            self.x_move = 100 * math.cos(self.idle_image_direction)
-            self.y_move = 100 * math.sin(self.idle_image_direction)
-            self.last_idle_sprite = self.curr_idle_sprite
-            self.curr_idle_sprite = self.idle_image_queue.pop()
-            self.last_idle_image_ts = curr_ts
+            # Keep showing the current image until the next one has been decoded
+            next_animation = self.idle_image_loader.get(next_sprite.filename)
+            if next_animation is not None:
+                if self.idle_image_angle is not None:
+                    self.idle_image_angle = (self.idle_image_angle + 90 + random.randint(0, 180)) % 360
+                else:
+                    self.idle_image_angle = random.randint(0,359)
+                self.idle_image_direction = self.idle_image_angle * 2 * math.pi / 360
+                self.x_last = self.idle_image_x
+                self.y_last = self.idle_image_y
+                self.x_move = 100 * math.cos(self.idle_image_direction)
+                self.y_move = 100 * math.sin(self.idle_image_direction)
+                if self.last_idle_sprite is not None and self.last_idle_sprite is not self.curr_idle_sprite:
+                    self.last_idle_sprite.animation = None
+                self.last_idle_sprite = self.curr_idle_sprite
+                self.curr_idle_sprite = self.idle_image_queue.pop()
+                self.curr_idle_sprite.animation = next_animation
+                self.curr_idle_sprite.shown_ts = curr_ts
+                self.last_idle_image_ts = curr_ts
+                if self.idle_image_queue:
+                    self.idle_image_loader.request(self.idle_image_queue[-1].filename)
+            elif self.curr_idle_sprite is None:
+                return
 
-        if curr_ts - self.last_idle_image_ts < FADE_LENGTH_S:
-            if self.last_idle_sprite is not None:
+        progress = min(1, (curr_ts - self.last_idle_image_ts) / IDLE_IMAGE_TIMEOUT_S)
+        idle_fade = self.quality['idle_fade']
+        idle_blend = self.quality['idle_blend']
+        if curr_ts - self.last_idle_image_ts < FADE_LENGTH_S and idle_fade != 'cut':
+            # Fades already blend, so effects show their nearest frame to keep the cost of a plain fade
+            idle_blend = False
+            # Fading the outgoing image too costs a second full screen blend
+            if self.last_idle_sprite is not None and self.last_idle_sprite.animation is not None and idle_fade == 'crossfade':
                 last_alpha = 255 - int(255 * (curr_ts - self.last_idle_image_ts) / FADE_LENGTH_S)
-                self.last_idle_sprite.draw(surface, (self.x_last, self.y_last), last_alpha)
+                self.last_idle_sprite.draw(surface, (self.x_last, self.y_last), last_alpha, curr_ts, idle_blend)
             alpha = int(255 * (curr_ts - self.last_idle_image_ts) / FADE_LENGTH_S)
         else:
             alpha = 255
 
-        self.idle_image_x = int(self.x_move * (curr_ts - self.last_idle_image_ts) / IDLE_IMAGE_TIMEOUT_S)
-        self.idle_image_y = int(self.y_move * (curr_ts - self.last_idle_image_ts) / IDLE_IMAGE_TIMEOUT_S)
-        self.curr_idle_sprite.draw(surface, (self.idle_image_x, self.idle_image_y), alpha)
+        self.idle_image_x = int(self.x_move * progress)
+        self.idle_image_y = int(self.y_move * progress)
+        self.curr_idle_sprite.draw(surface, (self.idle_image_x, self.idle_image_y), alpha, curr_ts, idle_blend)
+        self.startup_timer.mark('first idle image')
+
+    def idle_frame_interval(self, fps):
+        # Fades need the full frame rate, otherwise the slideshow is drawn at IDLE_RENDER_FPS,
+        # and right when the next image is due
+        curr_ts = time.time()
+        if self.last_idle_image_ts is None:
+            return 1 / IDLE_RENDER_FPS
+        if curr_ts - self.last_idle_image_ts < FADE_LENGTH_S:
+            return 1 / fps
+        next_image_s = self.last_idle_image_ts + IDLE_IMAGE_TIMEOUT_S - curr_ts
+        if next_image_s > 0:
+            return min(1 / IDLE_RENDER_FPS, next_image_s)
+        return 1 / IDLE_RENDER_FPS
+
+    def cpu_time(self, capture):
+        # This process, plus the tracker process if the tracker runs in one
+        cpu_s = time.process_time()
+        if capture is not None:
+            cpu_s += capture.child_cpu_time()
+        return cpu_s
+
+    def add_cpu_usage(self, cpu_usage, mode, cpu_ts, capture):
+        # Returns the times to count the next frame from
+        now = (self.cpu_time(capture), time.perf_counter())
+        cpu_usage[mode][0] += now[0] - cpu_ts[0]
+        cpu_usage[mode][1] += now[1] - cpu_ts[1]
+        return now
+
+    def cpu_usage_summary(self, cpu_usage):
+        parts = []
+        for mode in ('idle', 'active'):
+            cpu_s, wall_s = cpu_usage[mode]
+            if wall_s > 0:
+                parts.append('{} {:.0f}% over {:.0f} s'.format(mode, 100 * cpu_s / wall_s, wall_s))
+        return 'cpu: ' + ', '.join(parts)
 
     def display_fps(self, clock, surface):
-        text_to_show = pygame.font.SysFont('Arial', 32).render(str(int(clock.get_fps())), 0, pygame.Color('white'))
-        surface.blit(text_to_show, (0, 0))
+        if self.stats_overlay is None:
+            self.stats_overlay = StatsOverlay(self.stats, SHOW_STATS)
+        return self.stats_overlay.draw(clock, surface)
 
     def draw_user_message(self, surface):
-        message = 'Hi!!! Stand in front of the screen, one person at a time, holding your arms out in a T.'
-        text_image = pygame.font.SysFont('Arial', 64).render(message, 0, pygame.Color('white'))
-        width_surface, height_surface = surface.get_size()
-        width_text, height_text = text_image.get_size()
-        width_scaled = int(width_surface * 0.9)
-        height_scaled = int(height_text * width_scaled / width_text)
-        scaled_text = pygame.transform.scale(text_image, (width_scaled, height_scaled))
-        width_background = int(width_surface * 0.95)
-        height_background = height_scaled + width_background - width_scaled
-        background = pygame.Surface((width_background, height_background))
-        background.fill((0, 0, 0))
-        x_background = int((width_surface - width_background) / 2)
-        y_background = int((height_surface - height_background) / 2)
-        surface.blit(background, (x_background, y_background))
-        x_text = int((width_surface - width_scaled) / 2)
-        y_text = int((height_surface - height_scaled) / 2)
-        if MIRRORED:
-            surface.blit(scaled_text, (x_text, y_text))
-        else:
-            flipped_text = pygame.transform.flip(scaled_text, True, False)
-            surface.blit(flipped_text, (x_text, y_text))
+        # The message never changes, so it's only rendered and scaled once
+        if self.message_image is None or self.message_image[0] != surface.get_size():
+            message = 'Hi!!! Stand in front of the screen, one person at a time, holding your arms out in a T.'
+            if self.message_font is None:
+                self.message_font = pygame.font.SysFont('Arial', 64)
+            text_image = self.message_font.render(message, 0, pygame.Color('white'))
+            width_surface, height_surface = surface.get_size()
+            width_text, height_text = text_image.get_size()
+            width_scaled = int(width_surface * 0.9)
+            height_scaled = int(height_text * width_scaled / width_text)
+            scaled_text = pygame.transform.scale(text_image, (width_scaled, height_scaled))
+            width_background = int(width_surface * 0.95)
+            height_background = height_scaled + width_background - width_scaled
+            background = pygame.Surface((width_background, height_background))
+            background.fill((0, 0, 0))
+            x_background = int((width_surface - width_background) / 2)
+            y_background = int((height_surface - height_background) / 2)
+            # Relative to the background, positioned as if drawn straight onto the surface
+            x_text = int((width_surface - width_scaled) / 2) - x_background
+            y_text = int((height_surface - height_scaled) / 2) - y_background
+            if MIRRORED:
+                background.blit(scaled_text, (x_text, y_text))
+            else:
+                flipped_text = pygame.transform.flip(scaled_text, True, False)
+                background.blit(flipped_text, (x_text, y_text))
+            self.message_image = (surface.get_size(), background, (x_background, y_background))
+        _, background, position = self.message_image
+        surface.blit(background, position)
 
-    def run(self):
+    def run(self, max_frames=None, fps=60, lockstep=False):
+        # The tilt and driver init happen on the capture thread, so idle images can show
+        # while they are still running
+        capture = None
         if not DEBUG_NO_KINECT:
-            self.set_kinect_angle(KINECT_ANGLE)
-            dev, user_tracker = self.init_kinect()
-            dev_name = dev.get_device_info().name.decode('UTF-8')
-            print("Device Name: {}".format(dev_name))
-            use_kinect = False
-            if dev_name == 'Kinect':
-                use_kinect = True
-                print('using Kinect.')
-            (kinect_width, kinect_height) = CAPTURE_SIZE_KINECT if use_kinect else CAPTURE_SIZE_OTHERS
-
-        pygame.init()
-        pygame.mouse.set_visible(False)
-        clock = pygame.time.Clock()
-
-        if FULL_SCREEN:
-            display_surface = pygame.display.set_mode((0, 0), pygame.FULLSCREEN)
-        else:
-            display_surface = pygame.display.set_mode((WINDOWED_WIDTH, WINDOWED_HEIGHT), 0, 32)
+            recorder = SkeletonRecorder(self.record_filename) if self.record_filename else None
+            tilt_angle = KINECT_ANGLE if self.replay_tracker is None else None
+            if TRACKER_PROCESS and not lockstep:
+                capture = TrackerSupervisor(self.replay_tracker, self.stats, self.startup_timer, recorder, tilt_angle)
+            else:
+                capture = TrackerCapture(KinectDriver(self.replay_tracker), self.stats, self.startup_timer,
+                                         recorder, lockstep, tilt_angle)
+            capture.start()
+        self.load_idle_images()
+
+        with self.startup_timer.phase('display init'):
+            pygame.init()
+            pygame.mouse.set_visible(False)
+            clock = pygame.time.Clock()
+
+            if RENDER_BACKEND == 'texture':
+                # Everything goes through the compositor, which also stands in for the display surface
+                size = pygame.display.get_desktop_sizes()[0] if FULL_SCREEN else (WINDOWED_WIDTH, WINDOWED_HEIGHT)
+                self.compositor = TextureCompositor(size, FULL_SCREEN, self.atlas)
+                self.sprite_cache = None
+                display_surface = self.compositor
+            elif FULL_SCREEN:
+                display_surface = pygame.display.set_mode((0, 0), pygame.FULLSCREEN)
+            else:
+                display_surface = pygame.display.set_mode((WINDOWED_WIDTH, WINDOWED_HEIGHT), 0, 32)
+        self.atlas.convert = self.compositor is None
+        self.atlas.display_ready.set()
+        self.idle_image_loader.set_display_size(display_surface.get_size(), convert=self.compositor is None)
 
         width_display, height_display = display_surface.get_size()
 
         ratio = DEPTH_SPACE_WIDTH / DEPTH_SPACE_HEIGHT
-        skeleton_surface = pygame.Surface((DEPTH_SPACE_WIDTH, DEPTH_SPACE_HEIGHT))
-        idle_image_surface = pygame.Surface((width_display, height_display))
         height_scaled = height_display
         width_scaled = math.floor(height_display * ratio)
         if ASPECT_RATIO > ratio:
             width_margin = int((ASPECT_RATIO * height_display - width_scaled) / 2)
         else:
             width_margin = 0
+        # Body parts are drawn straight onto the display, clipped to the scaled depth space
+        skeleton_rect = pygame.Rect(width_margin, 0, width_scaled, height_scaled)
+        self.joint_batch.set_display_transform(height_scaled / DEPTH_SPACE_HEIGHT, width_margin, width_scaled, MIRRORED)
+        if self.silhouette is not None:
+            self.silhouette.set_display_transform(height_scaled / DEPTH_SPACE_HEIGHT, width_margin, width_scaled, MIRRORED)
 
         running = True
         frame_count = 0
+        stats_dumper = StatsDumper(self.stats, self.stats_filename) if self.stats_filename else None
+        governor = QualityGovernor(fps) if GOVERNOR_ENABLED and fps else None
+        load_start_ts = time.perf_counter()
+        idle_throttle = bool(IDLE_RENDER_FPS and fps and IDLE_RENDER_FPS < fps and not lockstep)
+        next_idle_frame_ts = 0
+        # CPU time (of the tracker process too) and wall time spent while idle and while someone is around
+        cpu_usage = {'idle': [0, 0], 'active': [0, 0]}
+        cpu_ts = (self.cpu_time(capture), time.perf_counter())
         while running:
-            clock.tick(60)
+            idle = idle_throttle and self.last_user_ts is None
+            if idle:
+                # Sleep until the slideshow needs drawing, but wake up for tracker frames in case
+                # someone showed up
+                wait_s = next_idle_frame_ts - time.perf_counter()
+                if wait_s > 0:
+                    if DEBUG_NO_KINECT:
+                        time.sleep(wait_s)
+                    else:
+                        capture.buffer.wait(wait_s)
+                clock.tick()
+            else:
+                clock.tick(fps)
 
+            frame_start_ts = time.perf_counter()
             for event in pygame.event.get():
                 if event.type == pygame.KEYDOWN:
                     if event.unicode == 'q' or event.unicode == 'Q':
@@ -428,69 +2484,293 @@ class HalloweenSkeleton():
                         break;
                 if event.type == pygame.QUIT:
                     running = False
+            self.stats.add('events', time.perf_counter() - frame_start_ts)
 
-            user_tracked = False
+            dirty_rects = None
             if not DEBUG_NO_KINECT:
-                skeleton_surface.fill((0, 0, 0))
-                if not self.kinect_initialized:
-                    dev, user_tracker = self.init_kinect()
-                ut_frame = user_tracker.read_frame()
-                frame_count = frame_count + 1
-                if ut_frame.users:
-                    for user in ut_frame.users:
-                        if user.is_new():
-                            if not user_tracked:
-                                self.untracked_user = True
-                            self.last_user_ts = time.time()
-                            print("{}: new human id:{} detected.".format(frame_count, user.id))
-                            user_tracker.start_skeleton_tracking(user.id)
-                        elif (user.state == nite2.UserState.NITE_USER_STATE_VISIBLE and
-                              user.skeleton.state == nite2.SkeletonState.NITE_SKELETON_TRACKED):
-                            self.last_user_ts = time.time()
-                            confidence = self.draw_skeleton(skeleton_surface, user_tracker, user)
-                            self.untracked_user = False
-                            user_tracked = True
-                        else:
-                            if not user_tracked:
-                                self.untracked_user = True
-                else:
-                    self.untracked_user = False
-                    self.last_user_ts = None
+                if capture.error is not None:
+                    raise capture.error
+                update_ts = time.perf_counter()
+                captured = None
+                tracker_fps = self.quality['tracker_fps']
+                if (tracker_fps is None or self.last_processed_ts is None or
+                        frame_start_ts >= self.last_processed_ts + 1 / tracker_fps):
+                    captured = capture.buffer.take_latest()
+                processed = False
+                if captured is not None:
+                    with capture.driver_lock:
+                        if captured.generation == capture.generation:
+                            self.stats.add('capture.age', frame_start_ts - captured.timestamp)
+                            self.process_frame(captured)
+                            self.last_processed_ts = frame_start_ts
+                            processed = True
+                # Without the filter there's nothing new to draw until the next tracker frame
+                if self.drawn_users and (processed or self.joint_batch.joint_filter is not None):
+                    self.update_poses(frame_start_ts + JOINT_PREDICTION_LEAD_S)
+                    processed = True
+                if processed:
+                    self.stats.add('update', time.perf_counter() - update_ts)
 
                 curr_ts = time.time()
                 if self.last_user_ts is not None and curr_ts > self.last_user_ts + RESET_TIMEOUT_S:
-                    for user in ut_frame.users:
-                        user_tracker.stop_skeleton_tracking(user.id)
-                    # print('{}: Reset after {} seconds'.format(frame_count, RESET_TIMEOUT_S))
+                    # print('{}: Reset after {} seconds'.format(capture.frame_count, RESET_TIMEOUT_S))
                     self.last_user_ts = None
-                    self.close_kinect()
+                    for user_id in list(self.sprites_lists):
+                        self.evict_user(user_id)
+                    capture.request_reset()
+
+                if idle and self.last_user_ts is None and frame_start_ts < next_idle_frame_ts:
+                    # Woken up by a frame with nobody in it, the slideshow can wait
+                    cpu_ts = self.add_cpu_usage(cpu_usage, 'idle', cpu_ts, capture)
+                    continue
 
-                display_surface.fill((0, 0, 0))
-                if MIRRORED:
-                    flipped_surface = pygame.transform.flip(skeleton_surface, True, False)
-                    scaled_surface = pygame.transform.scale(flipped_surface, (width_scaled, height_scaled))
+                stage_ts = time.perf_counter()
+                # The silhouette changes all over, so it's always drawn on a full frame
+                use_dirty_rects = (DIRTY_RECTS and self.last_user_ts is not None and not self.untracked_user and
+                                   self.silhouette is None)
+                if self.last_user_ts is None:
+                    # Nobody to draw, the slideshow repaints everything
+                    display_surface.fill((0, 0, 0))
+                    self.full_frame_pending = True
+                elif self.compositor is not None:
+                    self.compositor.fill((0, 0, 0))
+                    if self.silhouette is not None and self.drawn_users:
+                        self.silhouette.draw(self.compositor)
+                    self.compositor.draw_parts([self.sprites_lists[user_id] for user_id in self.drawn_users], skeleton_rect)
+                elif use_dirty_rects and not self.full_frame_pending:
+                    display_surface.set_clip(skeleton_rect)
+                    dirty_rects = self.draw_skeletons(display_surface, dirty=True)
                 else:
-                    scaled_surface = pygame.transform.scale(skeleton_surface, (width_scaled, height_scaled))
-                display_surface.blit(scaled_surface, (width_margin, 0))
+                    # The previous frame may have covered the whole display, so repaint all of it
+                    display_surface.fill((0, 0, 0))
+                    display_surface.set_clip(skeleton_rect)
+                    if self.silhouette is not None and self.drawn_users:
+                        self.silhouette.draw(display_surface)
+                    self.draw_skeletons(display_surface)
+                    self.full_frame_pending = not use_dirty_rects
+                if self.compositor is None:
+                    display_surface.set_clip(None)
+                self.stats.add('draw', time.perf_counter() - stage_ts)
 
             # @TODO: Seems to be interfering with tracking (CPU utilization?)
             # if self.last_user_ts is None or self.untracked_user:
             if self.last_user_ts is None:
-                idle_image_surface.fill((0, 0, 0))
-                self.draw_idle_images(idle_image_surface)
-                display_surface.blit(idle_image_surface, (0, 0))
+                stage_ts = time.perf_counter()
+                if DEBUG_NO_KINECT:
+                    # Otherwise the display was already cleared for this frame above
+                    display_surface.fill((0, 0, 0))
+                self.draw_idle_images(display_surface)
+                if idle_throttle:
+                    next_idle_frame_ts = frame_start_ts + self.idle_frame_interval(fps)
+                self.stats.add('idle', time.perf_counter() - stage_ts)
 
             if self.untracked_user:
+                stage_ts = time.perf_counter()
                 self.draw_user_message(display_surface)
+                self.stats.add('message', time.perf_counter() - stage_ts)
 
-            if SHOW_FPS:
-                self.display_fps(clock, display_surface)
+            if SHOW_FPS or SHOW_STATS:
+                if dirty_rects is not None and self.fps_rect is not None:
+                    dirty_rects.append(display_surface.fill((0, 0, 0), self.fps_rect))
+                self.fps_rect = self.display_fps(clock, display_surface)
+                if dirty_rects is not None:
+                    dirty_rects.append(self.fps_rect)
 
-            pygame.display.flip()
+            if self.synthetic_load_s:
+                if self.load_period_s is None or int((frame_start_ts - load_start_ts) / self.load_period_s) % 2 == 0:
+                    load_end_ts = time.perf_counter() + self.synthetic_load_s
+                    while time.perf_counter() < load_end_ts:
+                        pass
 
+            stage_ts = time.perf_counter()
+            if self.compositor is not None:
+                self.compositor.present()
+            elif dirty_rects is not None:
+                pygame.display.update(dirty_rects)
+            else:
+                pygame.display.flip()
+            frame_end_ts = time.perf_counter()
+            if frame_count == 0:
+                self.startup_timer.mark('first frame')
+            self.stats.add('flip', frame_end_ts - stage_ts)
+            self.stats.add('frame', frame_end_ts - frame_start_ts)
+            if stats_dumper is not None:
+                stats_dumper.poll()
+            if governor is not None:
+                level = governor.observe(frame_end_ts - frame_start_ts, frame_end_ts)
+                if level is not None:
+                    self.set_quality(QUALITY_LEVELS[level])
+
+            cpu_ts = self.add_cpu_usage(cpu_usage, 'idle' if idle and self.last_user_ts is None else 'active', cpu_ts, capture)
+
+            frame_count = frame_count + 1
+            if max_frames is not None and frame_count >= max_frames:
+                running = False
+
+        if not DEBUG_NO_KINECT:
+            capture.stop()
+            print(capture.summary())
+        if self.idle_image_loader is not None:
+            self.idle_image_loader.stop()
+        if stats_dumper is not None:
+            stats_dumper.dump()
+        if governor is not None:
+            print('quality: {} changes, ended at level {}'.format(governor.changes, governor.level))
+        if idle_throttle:
+            print(self.cpu_usage_summary(cpu_usage))
+        print(self.stats.summary())
         pygame.quit()
-        self.close_kinect()
+        if self.sprite_cache is not None:
+            print(self.sprite_cache.stats())
+
+def benchmark_report(stats, stages=('update', 'silhouette', 'draw', 'flip', 'frame')):
+    print('{:>10} {:>8} {:>8} {:>8} {:>8}'.format('stage', 'samples', 'p50 ms', 'p95 ms', 'p99 ms'))
+    for stage in stages:
+        if not stats.counts[stage]:
+            continue
+        print('{:>10} {:>8} {:>8.2f} {:>8.2f} {:>8.2f}'.format(
+            stage, stats.counts[stage], 1000 * stats.percentile(stage, 50),
+            1000 * stats.percentile(stage, 95), 1000 * stats.percentile(stage, 99)))
+
+def sweep_report(results, label='users', stages=('update', 'draw', 'frame')):
+    # results maps what was varied (user counts, backends) to the StageStats of its benchmark run
+    print('{:>8}'.format(label) + ''.join(' {:>13} {:>13}'.format(stage + ' p50', stage + ' p95') for stage in stages))
+    for user_count, stats in results.items():
+        print('{:>8}'.format(user_count) + ''.join(' {:>13.2f} {:>13.2f}'.format(
+            1000 * stats.percentile(stage, 50), 1000 * stats.percentile(stage, 95)) for stage in stages))
+
+def filter_report(frames, noise=0, lead=JOINT_PREDICTION_LEAD_S):
+    # Runs the joint filter over the first tracked user of a recording the way the render loop does,
+    # showing each pose lead seconds after its frame was read. Jitter is the RMS second difference
+    # of the shown positions and latency the time shift that best lines them up with the input,
+    # both over confident joints in depth pixels. The unfiltered rows show the cost of doing nothing.
+    tracked = [(frame.timestamp, user) for frame in frames for user in frame.users
+               if user.skeleton.state == nite2.SkeletonState.NITE_SKELETON_TRACKED]
+    if len(tracked) < 3:
+        print('filter report: not enough tracked frames')
+        return
+    user_id = tracked[0][1].id
+    tracked = [(ts, user) for ts, user in tracked if user.id == user_id]
+    times = np.array([ts for ts, _ in tracked])
+    clean = np.array([user.record['depth'] for _, user in tracked], dtype=np.float64)
+    confidence = np.array([user.record['confidence'] for _, user in tracked], dtype=np.float64)
+    measured = clean + np.random.default_rng(0).normal(0, noise, clean.shape) if noise else clean
+    confident = (confidence > JOINT_CONFIDENCE_THRESHOLD).all(axis=0)
+
+    def shown_at(shift, shown):
+        # Clean input at display time minus shift, against the shown positions
+        query = np.clip(times + lead - shift, times[0], times[-1])
+        index = np.clip(np.searchsorted(times, query) - 1, 0, len(times) - 2)
+        weight = ((query - times[index]) / (times[index + 1] - times[index]))[:, None, None]
+        reference = clean[index] * (1 - weight) + clean[index + 1] * weight
+        return np.sqrt(((shown - reference)[:, confident] ** 2).sum(axis=-1).mean())
+
+    configs = [
+        ('unfiltered', None),
+        ('no prediction', JointFilter(max_prediction_s=0)),
+        ('default', JointFilter()),
+        ('min cutoff x2', JointFilter(min_cutoff=2 * JOINT_FILTER_MIN_CUTOFF)),
+        ('min cutoff /2', JointFilter(min_cutoff=JOINT_FILTER_MIN_CUTOFF / 2)),
+        ('beta x4', JointFilter(beta=4 * JOINT_FILTER_BETA)),
+        ('beta /4', JointFilter(beta=JOINT_FILTER_BETA / 4)),
+    ]
+    shifts = np.arange(-0.05, 0.2, 0.001)
+    print('{} frames, noise {} px, shown {:.0f} ms after each frame is read'.format(len(times), noise, 1000 * lead))
+    print('{:>14} {:>10} {:>12} {:>10}'.format('filter', 'jitter px', 'latency ms', 'error px'))
+    for name, joint_filter in configs:
+        if joint_filter is None:
+            shown = measured
+        else:
+            shown = np.empty_like(measured)
+            for k, ts in enumerate(times):
+                joint_filter.update([user_id], measured[k][None], confidence[k][None], ts)
+                shown[k] = joint_filter.predict([user_id], ts + lead)[0][0]
+        jitter = np.sqrt((np.diff(shown, n=2, axis=0)[:, confident] ** 2).sum(axis=-1).mean())
+        errors = [shown_at(shift, shown) for shift in shifts]
+        print('{:>14} {:>10.2f} {:>12.0f} {:>10.2f}'.format(
+            name, jitter, 1000 * shifts[int(np.argmin(errors))], shown_at(0, shown)))
 
 if __name__ == '__main__':
-    skel = HalloweenSkeleton()
-    skel.run()
+    parser = argparse.ArgumentParser(description='Kinect halloween skeleton')
+    parser.add_argument('--record', metavar='FILE', help='record tracked skeletons to FILE')
+    parser.add_argument('--replay', metavar='FILE', help='replay a skeleton recording instead of using the Kinect')
+    parser.add_argument('--benchmark', action='store_true',
+                        help='render headless as fast as possible and report frame time percentiles')
+    parser.add_argument('--size', default='{}x{}'.format(*BENCHMARK_SIZE), help='benchmark display size, e.g. 1920x1080')
+    parser.add_argument('--users', type=int, help='number of users to replay, cloning recorded users as needed')
+    parser.add_argument('--sweep', action='store_true',
+                        help='benchmark each of {} users and compare frame times'.format(
+                            ', '.join(str(n) for n in BENCHMARK_USER_COUNTS)))
+    parser.add_argument('--frames', type=int, default=BENCHMARK_FRAMES, help='number of frames to benchmark')
+    parser.add_argument('--backend', choices=('surface', 'texture'), default=RENDER_BACKEND,
+                        help='draw with pygame surface blits or SDL renderer textures')
+    parser.add_argument('--compare-backends', action='store_true', help='benchmark both render backends')
+    parser.add_argument('--stats', metavar='FILE',
+                        help='append frame time stats to FILE every {} s (CSV if FILE ends in .csv, JSON lines otherwise)'.format(
+                            STATS_DUMP_INTERVAL_S))
+    parser.add_argument('--show-stats', action='store_true', help='show FPS and frame stage times on screen')
+    parser.add_argument('--rig', default=RIG, help='costume to draw, from {}'.format(RIG_FILE))
+    parser.add_argument('--silhouette', action='store_true', help='draw a silhouette of tracked users from the depth camera')
+    parser.add_argument('--load', type=float, metavar='MS', help='add MS of busy time to every frame, to test the quality governor')
+    parser.add_argument('--load-period', type=float, metavar='S', help='switch the --load on and off every S seconds')
+    parser.add_argument('--filter-report', action='store_true',
+                        help='measure joint filter jitter and latency on the replay (or a noisy synthetic skeleton)')
+    args = parser.parse_args()
+
+    if args.show_stats:
+        SHOW_STATS = True
+    if args.silhouette:
+        SILHOUETTE_ENABLED = True
+    RIG = args.rig
+    RENDER_BACKEND = args.backend
+
+    if args.filter_report:
+        if args.replay:
+            filter_report(load_recording(args.replay)[1])
+        else:
+            filter_report(synthesize_recording()[1], noise=FILTER_REPORT_NOISE)
+        sys.exit()
+
+    replay_tracker = None
+    if args.replay:
+        replay_tracker = ReplayUserTracker.open(args.replay, user_count=args.users, realtime=not args.benchmark)
+    elif args.benchmark:
+        replay_tracker = ReplayUserTracker(*synthesize_recording(user_maps=SILHOUETTE_ENABLED), user_count=args.users,
+                                           realtime=False)
+
+    if args.benchmark:
+        os.environ['SDL_VIDEODRIVER'] = 'dummy'
+        FULL_SCREEN = False
+        WINDOWED_WIDTH, WINDOWED_HEIGHT = (int(v) for v in args.size.lower().split('x'))
+        DEBUG_NO_KINECT = False
+        if args.sweep:
+            results = collections.OrderedDict()
+            for user_count in BENCHMARK_USER_COUNTS:
+                replay_tracker.user_count = user_count
+                replay_tracker.position = 0
+                skel = HalloweenSkeleton(replay_tracker)
+                skel.stats = StageStats(window=args.frames)
+                skel.run(max_frames=args.frames, fps=0, lockstep=True)
+                results[user_count] = skel.stats
+            sweep_report(results)
+        elif args.compare_backends:
+            results = collections.OrderedDict()
+            for backend in ('surface', 'texture'):
+                RENDER_BACKEND = backend
+                replay_tracker.position = 0
+                skel = HalloweenSkeleton(replay_tracker)
+                skel.stats = StageStats(window=args.frames)
+                skel.run(max_frames=args.frames, fps=0, lockstep=True)
+                results[backend] = skel.stats
+            sweep_report(results, label='backend', stages=('update', 'draw', 'idle', 'flip', 'frame'))
+        else:
+            skel = HalloweenSkeleton(replay_tracker, args.record, args.stats)
+            skel.stats = StageStats(window=args.frames)
+            skel.run(max_frames=args.frames, fps=0, lockstep=True)
+            benchmark_report(skel.stats)
+    else:
+        skel = HalloweenSkeleton(replay_tracker, args.record, args.stats)
+        if args.load:
+            skel.synthetic_load_s = args.load / 1000
+            skel.load_period_s = args.load_period
+        skel.run()